@@ -6,6 +6,15 @@ STORAGE_DIR = Path("storage")
 LANCE_DIR = STORAGE_DIR / "lancedb"
 CHUNK_JSONL = STORAGE_DIR / "chunks.jsonl"
 BM25_PATH = STORAGE_DIR / "bm25.pkl"
+# versioned index generations (see snapshots.py); the paths above are the legacy layout
+GENERATIONS_DIR = STORAGE_DIR / "generations"
+CURRENT_POINTER = STORAGE_DIR / "CURRENT"
+GENERATIONS_KEEP = 2          # newest generations never garbage-collected
+GENERATION_GRACE_S = 600      # superseded generations stay readable at least this long
+# cross-worker runtime state (selected model, job progress); see runtime.py
+RUNTIME_DIR = STORAGE_DIR / "runtime"
+JOB_HEARTBEAT_S = 15          # running ingest/batch jobs refresh `updated_at` this often
+JOB_STALE_S = 120             # unfinished job whose owner died or went this long without a heartbeat -> error
 
 # ingestion
 CHUNK_TOKENS = 800     # ~800-token target
@@ -13,23 +22,69 @@ CHUNK_OVERLAP = 120
 
 # retrieval
 DENSE_TOPK = 150
+# first-pass dense search over compact codes: "none" (LanceDB float32), "int8" or "binary";
+# the top DENSE_TOPK * DENSE_RESCORE_FACTOR are rescored with full-precision vectors
+DENSE_QUANT = "none"
+DENSE_QUANT_DIR = STORAGE_DIR / "dense_quant"
+DENSE_RESCORE_FACTOR = 4
 BM25_TOPK = 150
+# sparse side of hybrid retrieval: "bm25" (rank_bm25 over whitespace tokens) or "lexical"
+# (bge-m3 lexical weights, computed with the dense vectors in the same encoder pass at
+# ingest and query time; needs INFERENCE_BACKEND = "torch" and a re-ingest)
+SPARSE_MODE = "bm25"
+LEXICAL_KEEP_BM25 = False    # lexical mode: also build BM25 on ingest (fallback for switching back; costs a second sparse pass)
 FUSION_TOPK = 200      # union cap before rerank
 RERANK_TOPK = 8        # final context set size
+RERANK_BATCH_SIZE = 16
+RERANK_BUCKETED = True      # sort pairs by token length; per-batch max_length
+RERANK_WINDOW_WORDS = 0     # >0: score only the best query-matching window of each chunk
 RRF_K = 60             # Reciprocal Rank Fusion constant
 MMR_LAMBDA = 0.7       # 0..1, higher = more relevance, lower = more diversity
+# note cards retrieve with several focused sub-queries fused in one pass
+NOTE_SUB_QUERIES = True
+NOTE_QUERY_FACETS = [
+    "definition overview key concepts",
+    "mechanism pathophysiology",
+    "clinical features diagnostics criteria",
+    "management treatment dosing",
+    "complications monitoring red flags",
+]
+# deadline-aware degradation of interactive requests (see `Deadline` in query.py)
+RETRIEVAL_BUDGET_MS = 4000    # per-request retrieval budget, enforced only while other retrievals are in flight; payload `budget_ms` overrides, 0 = none
+DEGRADE_QUEUE_DEPTH = 4       # in-flight retrievals per worker: 1x shrinks fusion, 2x skips rerank, 3x dense-only
+DEGRADED_FUSION_TOPK = 50     # fusion cap once the queue is deep
+DEGRADE_MIN_RERANK = 16       # fewer affordable rerank pairs than this -> skip the cross-encoder
+STAGE_COST_ALPHA = 0.2        # EWMA weight of the newest stage-latency sample
+STAGE_SKIP_DECAY = 0.8        # estimate multiplier each time a stage is skipped because of it
+# identical concurrent /api/qa and /api/note requests share one retrieval + generation (singleflight.py)
+COALESCE_REQUESTS = True
 
 # models
 EMBED_MODEL_NAME = "BAAI/bge-m3"
 RERANK_MODEL_NAME = "BAAI/bge-reranker-v2-m3"
+# embedder/reranker runtime: "torch" (sentence-transformers + FlagEmbedding) or
+# "onnx" (int8 ONNX Runtime on CPU; export first with `python inference.py export`)
+INFERENCE_BACKEND = "torch"
+ONNX_DIR = STORAGE_DIR / "onnx"
+ONNX_THREADS = 0       # 0 = let ONNX Runtime decide
+EMBED_MAX_LENGTH = 1024
+RERANK_MAX_LENGTH = 512
 # LLM served by Ollama
 # Upgraded local default: Qwen2.5 14B Instruct (q4 quantization)
 # Pull via: `ollama pull qwen2.5:14b-instruct-q4_K_M`
 OLLAMA_MODEL = "qwen2.5:14b-instruct-q4_K_M"
+# backends come from OLLAMA_BASE_URLS (comma-separated) or OLLAMA_BASE_URL; see ollama_pool.py
+OLLAMA_HEALTH_COOLDOWN_S = 15   # skip a backend this long after a connection failure
+OLLAMA_TTFT_ALPHA = 0.3         # EWMA weight of the newest TTFT (streamed) / latency (non-streamed) sample
 
 # generation
 MAX_TOKENS = 700
 
+# batch (deck) generation
+BATCH_CONCURRENCY = 2         # parallel Ollama generations per batch
+BATCH_RETRIEVAL_CHUNK = 16    # items retrieved/reranked together before generation is queued
+BATCH_MAX_ITEMS = 1000        # per request cap for /api/batch
+
 # term expansion
 ENABLE_TERM_EXPANSION = True
 TERMS_MAP_PATH = STORAGE_DIR / "terms.yaml"
@@ -0,0 +1,228 @@
+"""Compact int8 / binary copies of the chunk embeddings for a two-phase dense search.
+
+Phase 1 scans the quantized codes (int8: 4x smaller than float32, binary: 32x) held
+memory-mapped in the index generation's dense_quant/ dir; phase 2 rescores only the
+shortlist with the full-precision vectors kept in LanceDB. DENSE_QUANT in config.py
+turns it on.
+
+CLI:
+  python dense_quant.py build                 # publish a new generation with codes for DENSE_QUANT
+  python dense_quant.py bench --q "..." ...   # memory / latency / recall: float vs int8 vs binary
+"""
+import argparse, json, os, time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from config import DENSE_QUANT, DENSE_TOPK, DENSE_RESCORE_FACTOR
+import snapshots
+
+QUANT_MODES = ("int8", "binary")
+# number of set bits for every byte value (Hamming distance on packed codes)
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+SCORE_BLOCK = 65536    # rows scored per block to bound temporary float memory
+
+_INDEX: Dict[tuple, tuple] = {}   # (dir, mode) -> (ids mtime, index)
+
+
+def quantize(embs: np.ndarray, mode: str) -> Dict[str, np.ndarray]:
+    embs = np.asarray(embs, dtype=np.float32)
+    if mode == "int8":
+        # symmetric per-dimension scales calibrated on the corpus itself
+        max_abs = np.maximum(np.abs(embs).max(axis=0), 1e-8)
+        scales = (127.0 / max_abs).astype(np.float32)
+        codes = np.clip(np.rint(embs * scales), -127, 127).astype(np.int8)
+        return {"codes": codes, "scales": scales}
+    if mode == "binary":
+        return {"codes": np.packbits(embs > 0, axis=1)}
+    raise ValueError(f"Unknown quantization mode '{mode}'")
+
+
+def first_pass_scores(index: Dict, qvec: np.ndarray) -> np.ndarray:
+    """Approximate similarity of `qvec` to every stored chunk (higher is better)."""
+    codes = index["codes"]
+    q = np.asarray(qvec, dtype=np.float32)
+    out = np.empty(codes.shape[0], dtype=np.float32)
+    if index["mode"] == "int8":
+        q_adj = q / index["scales"]
+        for s in range(0, codes.shape[0], SCORE_BLOCK):
+            out[s:s + SCORE_BLOCK] = codes[s:s + SCORE_BLOCK].astype(np.float32) @ q_adj
+    else:
+        qbits = np.packbits(q > 0)
+        for s in range(0, codes.shape[0], SCORE_BLOCK):
+            # signed sum: negating the default uint64 sum would wrap around
+            out[s:s + SCORE_BLOCK] = -POPCOUNT[np.bitwise_xor(codes[s:s + SCORE_BLOCK], qbits)].sum(axis=1, dtype=np.int32)
+    return out
+
+
+def two_phase_search(
+    index: Dict,
+    qvec: np.ndarray,
+    k: int,
+    fetch_vectors: Callable[[List[int]], np.ndarray],
+    mask: Optional[np.ndarray] = None,
+    rescore_factor: int = DENSE_RESCORE_FACTOR,
+) -> List[tuple]:
+    """Top-k (row index, cosine) pairs: quantized shortlist of k*rescore_factor, exact rescoring."""
+    scores = first_pass_scores(index, qvec)
+    if mask is not None:
+        scores = np.where(mask, scores, -np.inf)
+    n = int(mask.sum()) if mask is not None else scores.shape[0]
+    short_k = min(k * max(1, rescore_factor), n)
+    if short_k <= 0:
+        return []
+    short = np.argpartition(-scores, short_k - 1)[:short_k]
+    vecs = fetch_vectors([int(i) for i in short])
+    exact = np.asarray(vecs, dtype=np.float32) @ np.asarray(qvec, dtype=np.float32)
+    order = np.argsort(-exact)[:k]
+    return [(int(short[i]), float(exact[i])) for i in order]
+
+
+def save_index(embs: np.ndarray, ids: List[str], book_ids: List[str], mode: str, out_dir: Path):
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    q = quantize(embs, mode)
+    for name, arr in q.items():
+        tmp = out_dir / f"{mode}.{name}.tmp.npy"
+        np.save(tmp, arr)
+        os.replace(tmp, out_dir / f"{mode}.{name}.npy")
+    # ids are written last: their mtime marks the index as complete
+    tmp = out_dir / f"{mode}.ids.json.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"ids": list(ids), "book_ids": list(book_ids)}, f)
+    os.replace(tmp, out_dir / f"{mode}.ids.json")
+
+
+def load_index(mode: str, in_dir: Path) -> Dict:
+    """Memory-mapped quantized index for `mode`, cached until its ids file changes."""
+    in_dir = Path(in_dir)
+    key = (str(in_dir), mode)
+    ids_path = in_dir / f"{mode}.ids.json"
+    mtime = os.path.getmtime(ids_path)
+    hit = _INDEX.get(key)
+    if hit is None or hit[0] != mtime:
+        with open(ids_path, "r") as f:
+            meta = json.load(f)
+        index = {
+            "mode": mode,
+            "ids": meta["ids"],
+            "book_ids": np.asarray(meta["book_ids"], dtype=object),
+            "codes": np.load(in_dir / f"{mode}.codes.npy", mmap_mode="r"),
+        }
+        if mode == "int8":
+            index["scales"] = np.load(in_dir / f"{mode}.scales.npy")
+        # at most the current generation plus one still-pinned predecessor
+        while len(_INDEX) >= 2:
+            _INDEX.pop(next(iter(_INDEX)))
+        _INDEX[key] = hit = (mtime, index)
+    return hit[1]
+
+
+def _table_embeddings(lance_dir: Path):
+    import lancedb
+    tbl = lancedb.connect(str(lance_dir)).open_table("chunks")
+    df = tbl.to_pandas(columns=["id", "book_id", "embedding"])
+    embs = np.vstack(df["embedding"].values).astype(np.float32) if len(df) else np.zeros((0, 0), np.float32)
+    return embs, df["id"].tolist(), df["book_id"].tolist()
+
+
+def build_from_table(mode: str = DENSE_QUANT, lance_dir: Optional[Path] = None, out_dir: Optional[Path] = None):
+    """Quantize every embedding in a LanceDB `chunks` table (default: the current generation)."""
+    if mode not in QUANT_MODES:
+        return
+    gen = snapshots.current()
+    embs, ids, book_ids = _table_embeddings(lance_dir or gen.lance_dir)
+    save_index(embs, ids, book_ids, mode, out_dir or gen.dense_quant_dir)
+
+
+def publish_codes(mode: str) -> "snapshots.Generation":
+    """Publish a copy of the current generation with freshly built `mode` codes.
+
+    Published generations are immutable, so codes are never written into the live one.
+    """
+    with snapshots.writer():
+        base = snapshots.current()
+        gen = snapshots.begin(base, carry=True)
+        try:
+            build_from_table(mode, lance_dir=gen.lance_dir, out_dir=gen.dense_quant_dir)
+        except Exception:
+            snapshots.discard(gen)
+            raise
+        catalog = {k: v for k, v in base.catalog().items() if k not in ("generation", "published_at")}
+        catalog.update({"parent": base.name, "rebuilt": f"dense_quant:{mode}"})
+        catalog.pop("added_book", None)
+        return snapshots.publish(gen, catalog)
+
+
+def bench(queries: List[str], k: int = DENSE_TOPK) -> Dict:
+    """Index memory, per-query latency and recall@k of int8/binary two-phase search vs exact float.
+
+    `latency_ms` times the search path `query.dense_search` actually runs against the current
+    generation (LanceDB float search, or the quantized scan plus its two LanceDB fetches);
+    `in_memory_ms` times the same search over arrays already in memory (exact `embs @ q`, or
+    the quantized scan rescored from `embs`), which isolates the cost of the scan itself.
+    """
+    from inference import load_embedder
+    import query
+    gen = snapshots.current()
+    embs, ids, book_ids = _table_embeddings(gen.lance_dir)
+    qvecs = np.asarray(load_embedder().encode(queries, normalize_embeddings=True), dtype=np.float32)
+    report: Dict = {"chunks": len(ids), "queries": len(queries), "k": k}
+    n_q = max(1, len(queries))
+
+    def per_query_ms(fn) -> tuple:
+        t0 = time.perf_counter()
+        out = [fn(qv) for qv in qvecs]
+        return out, (time.perf_counter() - t0) * 1000.0 / n_q
+
+    def recall(found: List[set]) -> Optional[float]:
+        if not found:
+            return None
+        return float(np.mean([len(f & t) / float(max(1, len(t))) for f, t in zip(found, truth)]))
+
+    with snapshots.pinned(gen):
+        tbl = query._open_chunks()
+        _, lance_ms = per_query_ms(lambda qv: tbl.search(qv.tolist()).select(query.CHUNK_COLUMNS).limit(k).to_list())
+        exact, exact_ms = per_query_ms(lambda qv: np.argsort(-(embs @ qv))[:k])
+        truth = [{ids[i] for i in top} for top in exact]
+        report["float"] = {
+            "index_bytes": int(embs.nbytes),
+            "latency_ms": lance_ms,
+            "in_memory_ms": exact_ms,
+            "recall": 1.0,
+        }
+        for mode in QUANT_MODES:
+            q = quantize(embs, mode)
+            index = {"mode": mode, "ids": ids, "book_ids": np.asarray(book_ids, dtype=object), **q}
+            rows, served_ms = per_query_ms(lambda qv: query._dense_search_quant(qv.tolist(), index, k=k))
+            hits, scan_ms = per_query_ms(lambda qv: two_phase_search(index, qv, k, lambda idx: embs[idx]))
+            report[mode] = {
+                "index_bytes": int(sum(a.nbytes for a in q.values())),
+                "latency_ms": served_ms,
+                "in_memory_ms": scan_ms,
+                "recall": recall([{r["id"] for r in rs} for rs in rows]),
+                "in_memory_recall": recall([{ids[i] for i, _ in h} for h in hits]),
+            }
+    return report
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build")
+    b.add_argument("--mode", choices=QUANT_MODES, default=DENSE_QUANT if DENSE_QUANT in QUANT_MODES else "int8")
+    be = sub.add_parser("bench")
+    be.add_argument("--q", action="append", required=True, help="query (repeatable)")
+    be.add_argument("--k", type=int, default=DENSE_TOPK)
+    args = ap.parse_args()
+
+    if args.cmd == "build":
+        gen = publish_codes(args.mode)
+        print(f"published generation {gen.name} with {args.mode} codes in {gen.dense_quant_dir}")
+    else:
+        print(json.dumps(bench(args.q, k=args.k), indent=2))
+
+
+if __name__ == "__main__":
+    main()
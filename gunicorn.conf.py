@@ -0,0 +1,36 @@
+# Multi-worker serving: `gunicorn -c gunicorn.conf.py server:app`
+#
+# The app (and, via PRELOAD_MODELS, bge-m3, the reranker and the index handles) is loaded
+# once in the master and then forked, so model weights are shared copy-on-write and the
+# memory-mapped BM25 postings / quantized codes are shared through the page cache.
+# Models are only loaded in the master, never run, so no OpenMP thread pool exists at fork.
+import gc
+import multiprocessing
+import os
+
+os.environ.setdefault("PRELOAD_MODELS", "1")
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+# long LLM generations stream for minutes
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "600"))
+graceful_timeout = 30
+
+
+def pre_fork(server, worker):
+    # move everything allocated so far out of the GC's reach so collections in the
+    # workers don't touch (and un-share) the preloaded objects' pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # split the cores between workers instead of every worker spawning one thread per core
+    threads = max(1, multiprocessing.cpu_count() // max(1, workers))
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except Exception:
+        pass
@@ -0,0 +1,313 @@
+"""Embedder / reranker inference backends.
+
+INFERENCE_BACKEND in config.py picks the implementation:
+- "torch": sentence-transformers (bge-m3) + FlagEmbedding reranker, as before.
+- "onnx":  int8 dynamically-quantized ONNX Runtime sessions on CPU.
+
+With SPARSE_MODE = "lexical" the embedder is FlagEmbedding's BGEM3FlagModel instead,
+which additionally offers `encode_hybrid(texts)` -> (dense vectors, lexical weights).
+
+Both expose the same duck-typed surface the pipeline uses:
+`encode(texts, normalize_embeddings=True)` and `compute_score(pairs, batch_size=16)`.
+
+CLI:
+  python inference.py export            # export + quantize both models to ONNX_DIR
+  python inference.py parity            # compare ONNX scores against PyTorch
+  python inference.py bench             # queries/sec, torch vs onnx
+"""
+import argparse, json, tempfile, time
+from pathlib import Path
+from typing import List, Optional, Sequence, Union
+
+import numpy as np
+
+from config import (
+    EMBED_MODEL_NAME, RERANK_MODEL_NAME, INFERENCE_BACKEND, ONNX_DIR, ONNX_THREADS,
+    EMBED_MAX_LENGTH, RERANK_MAX_LENGTH, SPARSE_MODE,
+)
+
+ONNX_MODEL_FILE = "model.int8.onnx"
+
+
+def _torch_cuda() -> bool:
+    try:
+        import torch
+        return bool(torch.cuda.is_available())
+    except Exception:
+        return False
+
+
+def _session(model_dir: Path):
+    try:
+        import onnxruntime as ort
+    except ImportError as e:
+        raise RuntimeError("INFERENCE_BACKEND='onnx' requires onnxruntime (pip install onnxruntime)") from e
+    path = Path(model_dir) / ONNX_MODEL_FILE
+    if not path.exists():
+        raise RuntimeError(f"Missing {path}; run `python inference.py export` first")
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if ONNX_THREADS:
+        opts.intra_op_num_threads = ONNX_THREADS
+    return ort.InferenceSession(str(path), sess_options=opts, providers=["CPUExecutionProvider"])
+
+
+class OnnxEmbedder:
+    """bge-m3 dense embeddings (CLS pooling) from an int8 ONNX graph."""
+
+    def __init__(self, model_dir: Path = ONNX_DIR / "embed", max_length: int = EMBED_MAX_LENGTH):
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+        self.session = _session(model_dir)
+        self.max_length = max_length
+
+    def encode(self, sentences: Union[str, Sequence[str]], normalize_embeddings: bool = True,
+               batch_size: int = 16, **_) -> np.ndarray:
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        out: Optional[np.ndarray] = None
+        # length-sorted batches keep padding small; rows are written back in input order
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for s in range(0, len(order), batch_size):
+            idx = order[s:s + batch_size]
+            enc = self.tokenizer([texts[i] for i in idx], padding=True, truncation=True,
+                                 max_length=self.max_length, return_tensors="np")
+            vecs = self.session.run(None, {
+                "input_ids": enc["input_ids"].astype(np.int64),
+                "attention_mask": enc["attention_mask"].astype(np.int64),
+            })[0]
+            if out is None:
+                out = np.zeros((len(texts), vecs.shape[1]), dtype=np.float32)
+            out[idx] = vecs
+        if out is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        if normalize_embeddings:
+            out = out / (np.linalg.norm(out, axis=1, keepdims=True) + 1e-12)
+        return out[0] if single else out
+
+
+class OnnxReranker:
+    """bge-reranker-v2-m3 cross-encoder logits from an int8 ONNX graph (same scale as FlagReranker)."""
+
+    def __init__(self, model_dir: Path = ONNX_DIR / "rerank", max_length: int = RERANK_MAX_LENGTH):
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+        self.session = _session(model_dir)
+        self.max_length = max_length
+
+    def compute_score(self, sentence_pairs, batch_size: int = 16, max_length: Optional[int] = None, **_):
+        single = len(sentence_pairs) == 2 and isinstance(sentence_pairs[0], str)
+        pairs = [sentence_pairs] if single else list(sentence_pairs)
+        scores: List[float] = []
+        for s in range(0, len(pairs), batch_size):
+            batch = pairs[s:s + batch_size]
+            enc = self.tokenizer([p[0] for p in batch], [p[1] for p in batch], padding=True,
+                                 truncation=True, max_length=max_length or self.max_length, return_tensors="np")
+            logits = self.session.run(None, {
+                "input_ids": enc["input_ids"].astype(np.int64),
+                "attention_mask": enc["attention_mask"].astype(np.int64),
+            })[0]
+            scores.extend(float(x) for x in np.asarray(logits).reshape(-1))
+        return scores[0] if single else scores
+
+
+class M3Encoder:
+    """bge-m3 dense vectors and lexical (sparse) weights from one forward pass."""
+
+    def __init__(self, max_length: int = EMBED_MAX_LENGTH):
+        from FlagEmbedding import BGEM3FlagModel
+        self.model = BGEM3FlagModel(EMBED_MODEL_NAME, use_fp16=_torch_cuda())
+        self.max_length = max_length
+
+    def encode_hybrid(self, sentences: Sequence[str], batch_size: int = 16):
+        """(n, dim) normalized dense vectors and one {token id: weight} dict per text."""
+        texts = [sentences] if isinstance(sentences, str) else list(sentences)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32), []
+        out = self.model.encode(texts, batch_size=batch_size, max_length=self.max_length,
+                                return_dense=True, return_sparse=True, return_colbert_vecs=False)
+        dense = np.asarray(out["dense_vecs"], dtype=np.float32).reshape(len(texts), -1)
+        lexical = [{str(t): float(w) for t, w in lw.items()} for lw in out["lexical_weights"]]
+        return dense, lexical
+
+    def encode(self, sentences: Union[str, Sequence[str]], normalize_embeddings: bool = True,
+               batch_size: int = 16, **_) -> np.ndarray:
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        # BGEM3FlagModel always returns normalized dense vectors
+        dense = np.asarray(self.model.encode(texts, batch_size=batch_size, max_length=self.max_length,
+                                             return_dense=True, return_sparse=False,
+                                             return_colbert_vecs=False)["dense_vecs"], dtype=np.float32)
+        dense = dense.reshape(len(texts), -1)
+        return dense[0] if single else dense
+
+
+def load_embedder(backend: Optional[str] = None):
+    backend = backend or INFERENCE_BACKEND
+    if SPARSE_MODE == "lexical":
+        if backend == "onnx":
+            raise RuntimeError("SPARSE_MODE='lexical' needs INFERENCE_BACKEND='torch' (the ONNX export has no sparse head)")
+        return M3Encoder()
+    if backend == "onnx":
+        return OnnxEmbedder()
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(EMBED_MODEL_NAME)
+
+
+def load_reranker(backend: Optional[str] = None):
+    backend = backend or INFERENCE_BACKEND
+    if backend == "onnx":
+        return OnnxReranker()
+    from FlagEmbedding import FlagReranker
+    # fp16 only helps on GPU; on CPU it is silently ignored or slower
+    return FlagReranker(RERANK_MODEL_NAME, use_fp16=_torch_cuda())
+
+
+def export_models(out_dir: Path = ONNX_DIR):
+    """Export both models to ONNX and dynamically quantize weights to int8."""
+    import torch
+    from transformers import AutoModel, AutoModelForSequenceClassification, AutoTokenizer
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    class _Cls(torch.nn.Module):
+        def __init__(self, m):
+            super().__init__()
+            self.m = m
+
+        def forward(self, input_ids, attention_mask):
+            return self.m(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state[:, 0]
+
+    class _Logits(torch.nn.Module):
+        def __init__(self, m):
+            super().__init__()
+            self.m = m
+
+        def forward(self, input_ids, attention_mask):
+            return self.m(input_ids=input_ids, attention_mask=attention_mask).logits.view(-1)
+
+    specs = (
+        ("embed", EMBED_MODEL_NAME, AutoModel, _Cls),
+        ("rerank", RERANK_MODEL_NAME, AutoModelForSequenceClassification, _Logits),
+    )
+    for name, model_name, cls, wrap in specs:
+        dest = Path(out_dir) / name
+        dest.mkdir(parents=True, exist_ok=True)
+        tok = AutoTokenizer.from_pretrained(model_name)
+        tok.save_pretrained(str(dest))
+        model = wrap(cls.from_pretrained(model_name).eval())
+        enc = tok(["dummy query"], ["dummy passage"], return_tensors="pt")
+        # fp32 bge-m3 exceeds the 2GB protobuf limit, so it goes through external data in a temp dir
+        with tempfile.TemporaryDirectory() as tmp:
+            fp32 = Path(tmp) / "model.onnx"
+            with torch.no_grad():
+                torch.onnx.export(
+                    model, (enc["input_ids"], enc["attention_mask"]), str(fp32),
+                    input_names=["input_ids", "attention_mask"], output_names=["output"],
+                    dynamic_axes={"input_ids": {0: "batch", 1: "seq"},
+                                  "attention_mask": {0: "batch", 1: "seq"},
+                                  "output": {0: "batch"}},
+                    opset_version=17,
+                )
+            quantize_dynamic(str(fp32), str(dest / ONNX_MODEL_FILE), weight_type=QuantType.QInt8)
+        print(f"exported {model_name} -> {dest / ONNX_MODEL_FILE}")
+
+
+def _sample_texts(n: int) -> List[str]:
+    texts: List[str] = []
+    try:
+        from snapshots import current
+        with open(current().chunk_jsonl, "r") as f:
+            for line in f:
+                texts.append(json.loads(line)["text"])
+                if len(texts) >= n:
+                    break
+    except FileNotFoundError:
+        pass
+    if not texts:
+        texts = [
+            "Mean arterial pressure is determined by cardiac output and systemic vascular resistance.",
+            "Renal autoregulation keeps GFR stable via myogenic response and tubuloglomerular feedback.",
+            "Metformin is contraindicated in severe renal impairment because of lactic acidosis risk.",
+            "Diabetic ketoacidosis presents with hyperglycemia, ketonemia and anion gap metabolic acidosis.",
+        ]
+    return texts
+
+
+SAMPLE_QUERIES = [
+    "What determines mean arterial pressure?",
+    "metformin contraindications",
+    "DKA management",
+    "renal autoregulation mechanism",
+]
+
+
+def parity(n: int = 64) -> dict:
+    """Compare ONNX int8 outputs to the PyTorch models on sample chunks."""
+    texts = _sample_texts(n)
+    t_emb, o_emb = load_embedder("torch"), load_embedder("onnx")
+    a = np.asarray(t_emb.encode(texts, normalize_embeddings=True), dtype=np.float32)
+    b = np.asarray(o_emb.encode(texts, normalize_embeddings=True), dtype=np.float32)
+    cos = (a * b).sum(axis=1)
+
+    t_rr, o_rr = load_reranker("torch"), load_reranker("onnx")
+    report = {"texts": len(texts), "embed_cos_min": float(cos.min()), "embed_cos_mean": float(cos.mean())}
+    diffs, top1, rank_corr = [], 0, []
+    for q in SAMPLE_QUERIES:
+        pairs = [[q, t] for t in texts]
+        s_t = np.asarray(t_rr.compute_score(pairs, batch_size=16), dtype=np.float32)
+        s_o = np.asarray(o_rr.compute_score(pairs, batch_size=16), dtype=np.float32)
+        diffs.append(float(np.abs(s_t - s_o).max()))
+        top1 += int(np.argmax(s_t) == np.argmax(s_o))
+        # Spearman rank correlation
+        r_t, r_o = np.argsort(np.argsort(s_t)), np.argsort(np.argsort(s_o))
+        rank_corr.append(float(np.corrcoef(r_t, r_o)[0, 1]) if len(texts) > 1 else 1.0)
+    report.update({
+        "rerank_max_abs_diff": max(diffs),
+        "rerank_top1_agreement": top1 / len(SAMPLE_QUERIES),
+        "rerank_spearman_min": min(rank_corr),
+    })
+    return report
+
+
+def bench(backend: str, n_queries: int = 20, n_pairs: int = 50) -> dict:
+    """Queries/sec for one query encode + reranking `n_pairs` chunks, the per-request model work."""
+    texts = _sample_texts(n_pairs)
+    texts = (texts * (n_pairs // len(texts) + 1))[:n_pairs]
+    emb, rr = load_embedder(backend), load_reranker(backend)
+    # warm-up
+    emb.encode(SAMPLE_QUERIES[0], normalize_embeddings=True)
+    rr.compute_score([[SAMPLE_QUERIES[0], texts[0]]] * 2, batch_size=16)
+    t0 = time.perf_counter()
+    for i in range(n_queries):
+        q = SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)]
+        emb.encode(q, normalize_embeddings=True)
+        rr.compute_score([[q, t] for t in texts], batch_size=16)
+    dt = time.perf_counter() - t0
+    return {"backend": backend, "queries": n_queries, "pairs_per_query": n_pairs, "qps": n_queries / dt}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    ex = sub.add_parser("export")
+    ex.add_argument("--out", default=str(ONNX_DIR))
+    pa = sub.add_parser("parity")
+    pa.add_argument("--n", type=int, default=64)
+    be = sub.add_parser("bench")
+    be.add_argument("--queries", type=int, default=20)
+    be.add_argument("--pairs", type=int, default=50)
+    args = ap.parse_args()
+
+    if args.cmd == "export":
+        export_models(Path(args.out))
+    elif args.cmd == "parity":
+        print(json.dumps(parity(args.n), indent=2))
+    else:
+        results = [bench(b, args.queries, args.pairs) for b in ("torch", "onnx")]
+        for r in results:
+            print(json.dumps(r))
+        print(f"speedup: {results[1]['qps'] / results[0]['qps']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,18 @@
-import argparse, json, pickle
+import argparse, json, os, pickle
 from pathlib import Path
 import fitz  # PyMuPDF
+import numpy as np
 from tqdm import tqdm
 
-from sentence_transformers import SentenceTransformer
 from llama_index.core.node_parser import SentenceSplitter
 import lancedb
 from config import (
-    DATA_DIR, LANCE_DIR, CHUNK_JSONL, BM25_PATH,
-    CHUNK_TOKENS, CHUNK_OVERLAP, EMBED_MODEL_NAME,
+    DATA_DIR, STORAGE_DIR,
+    CHUNK_TOKENS, CHUNK_OVERLAP, SPARSE_MODE, LEXICAL_KEEP_BM25,
 )
+from inference import load_embedder
+import dense_quant
+import snapshots
 from rank_bm25 import BM25Okapi
 
 
@@ -38,20 +41,40 @@ def chunk_pages(pages, book_id: str):
             }
 
 
-def build_dense_index(rows, progress_cb=None):
-    LANCE_DIR.mkdir(parents=True, exist_ok=True)
-    db = lancedb.connect(str(LANCE_DIR))
+def _target(gen):
+    # writers get an explicit staging generation; None keeps the legacy flat layout
+    return gen or snapshots.Generation(snapshots.LEGACY, STORAGE_DIR)
+
+
+def build_dense_index(rows, progress_cb=None, gen=None, base=None):
+    """Embed and append `rows` to the generation's table.
+
+    With SPARSE_MODE = "lexical", the same encoder pass also yields bge-m3 lexical weights,
+    which are merged into `base`'s lexical postings (default: the current generation).
+    """
+    gen = _target(gen)
+    base = base or snapshots.current()
+    lexical = SPARSE_MODE == "lexical"
+    lex_ids, lex_weights = [], []
+    Path(gen.lance_dir).mkdir(parents=True, exist_ok=True)
+    db = lancedb.connect(str(gen.lance_dir))
     try:
         tbl = db.open_table("chunks")
     except Exception:
         tbl = None
 
-    model = SentenceTransformer(EMBED_MODEL_NAME)
+    model = load_embedder()
     total = len(rows)
     processed = 0
     batch = []
     for r in tqdm(rows, desc="Embedding + upsert"):
-        emb = model.encode(r["text"], normalize_embeddings=True).tolist()
+        if lexical:
+            dense, weights = model.encode_hybrid([r["text"]])
+            emb = dense[0].tolist()
+            lex_ids.append(r["id"])
+            lex_weights.append(weights[0])
+        else:
+            emb = model.encode(r["text"], normalize_embeddings=True).tolist()
         batch.append({"id": r["id"], "embedding": emb, "text": r["text"], **r["meta"]})
         processed += 1
         if progress_cb and processed % 20 == 0 and total:
@@ -70,6 +93,21 @@ def build_dense_index(rows, progress_cb=None):
             tbl = db.create_table("chunks", data=batch)
         else:
             tbl.add(batch)
+    # refresh the compact first-pass codes (no-op when DENSE_QUANT is "none")
+    dense_quant.build_from_table(lance_dir=gen.lance_dir, out_dir=gen.dense_quant_dir)
+    if lexical:
+        base_dir = base.lexical_dir if (Path(base.lexical_dir) / "terms.json").exists() else None
+        if base_dir is None and tbl is not None:
+            # first lexical ingest over an existing table: encode the older chunks once
+            new_ids = set(lex_ids)
+            df = tbl.to_pandas(columns=["id", "text"])
+            old = df[~df["id"].isin(new_ids)]
+            old_ids, old_texts = old["id"].tolist(), old["text"].tolist()
+            old_weights = []
+            for s in range(0, len(old_texts), 32):
+                old_weights.extend(model.encode_hybrid(old_texts[s:s + 32])[1])
+            lex_ids, lex_weights = old_ids + lex_ids, old_weights + lex_weights
+        save_lexical_postings(lex_weights, lex_ids, gen.lexical_dir, base_dir=base_dir)
     if progress_cb:
         try:
             progress_cb(1.0)
@@ -77,34 +115,162 @@ def build_dense_index(rows, progress_cb=None):
             pass
 
 
-def build_bm25(rows, progress_cb=None):
+def write_chunk_catalog(progress_cb=None, gen=None):
+    """Write chunks.jsonl for every chunk in the generation's table; returns the chunk frame."""
+    gen = _target(gen)
+    tbl = lancedb.connect(str(gen.lance_dir)).open_table("chunks")
+    df = tbl.to_pandas(columns=["id", "text", "book_id", "page_start", "page_end"])
     # Persist raw chunks for transparency
-    with open(CHUNK_JSONL, "w") as f:
-        total = len(rows)
+    with open(gen.chunk_jsonl, "w") as f:
+        total = len(df)
         processed = 0
-        for r in rows:
-            f.write(json.dumps(r) + "\n")
+        for r in df.to_dict(orient="records"):
+            meta = {"book_id": r["book_id"], "page_start": int(r["page_start"]), "page_end": int(r["page_end"])}
+            f.write(json.dumps({"id": r["id"], "text": r["text"], "meta": meta}) + "\n")
             processed += 1
             if progress_cb and processed % 50 == 0 and total:
                 try:
                     progress_cb(min(1.0, processed / float(total)))
                 except Exception:
                     pass
+    return df
+
+
+def build_bm25(rows, progress_cb=None, gen=None):
+    """Rebuild the chunk catalog and BM25 over every chunk in the generation's table.
+
+    `rows` are the newly added chunks; the index covers all books, not just this ingest.
+    """
+    gen = _target(gen)
+    df = write_chunk_catalog(progress_cb=progress_cb, gen=gen)
 
     # Tokenize very simply (whitespace + lower)
-    corpus, ids = [], []
-    for r in rows:
-        tokens = r["text"].lower().split()
-        corpus.append(tokens)
-        ids.append(r["id"])
+    corpus = [t.lower().split() for t in df["text"].tolist()]
+    ids = df["id"].tolist()
     bm25 = BM25Okapi(corpus)
-    with open(BM25_PATH, "wb") as f:
+    with open(gen.bm25_path, "wb") as f:
         pickle.dump({"bm25": bm25, "ids": ids}, f)
+    save_bm25_postings(bm25, ids, gen.bm25_postings_dir)
     if progress_cb:
         try:
             progress_cb(1.0)
         except Exception:
             pass
+    return df
+
+
+def save_bm25_postings(bm25, ids, out_dir: Path):
+    """Term -> (doc, BM25 weight) postings as flat .npy arrays that query workers memory-map.
+
+    Weights are the per-term BM25 contributions (idf * saturated tf), so query scoring
+    is a sparse sum instead of a pass over every document's term dict.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    doc_len = np.asarray(bm25.doc_len, dtype=np.float32)
+    len_norm = bm25.k1 * (1.0 - bm25.b + bm25.b * doc_len / bm25.avgdl)
+    postings = {}
+    for d, freqs in enumerate(bm25.doc_freqs):
+        for t, tf in freqs.items():
+            postings.setdefault(t, []).append((d, tf))
+    terms = sorted(postings)
+    indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+    docs_parts, weight_parts = [], []
+    for i, t in enumerate(terms):
+        plist = postings[t]
+        dd = np.fromiter((p[0] for p in plist), dtype=np.int32, count=len(plist))
+        tf = np.fromiter((p[1] for p in plist), dtype=np.float32, count=len(plist))
+        weight_parts.append((bm25.idf.get(t, 0.0) * tf * (bm25.k1 + 1.0) / (tf + len_norm[dd])).astype(np.float32))
+        docs_parts.append(dd)
+        indptr[i + 1] = indptr[i] + len(plist)
+    _write_postings(out_dir, terms, indptr, docs_parts, weight_parts, ids, np.float32)
+
+
+def save_lexical_postings(lexical_weights, ids, out_dir: Path, base_dir: Path = None):
+    """bge-m3 lexical weights as token -> (doc, weight) postings, in the BM25 postings layout.
+
+    Scoring a query is then the same sparse sum as BM25: the sum over shared tokens of
+    query weight * chunk weight. With `base_dir` (an earlier generation's lexical postings),
+    those postings are kept and the new chunks are appended after them, so an ingest only
+    encodes its own chunks. Weights are stored as float16.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    parts = {}
+    all_ids = []
+    if base_dir is not None:
+        base_dir = Path(base_dir)
+        with open(base_dir / "terms.json", "r") as f:
+            meta = json.load(f)
+        b_indptr = np.load(base_dir / "indptr.npy", mmap_mode="r")
+        b_docs = np.load(base_dir / "docs.npy", mmap_mode="r")
+        b_weights = np.load(base_dir / "weights.npy", mmap_mode="r")
+        for i, t in enumerate(meta["terms"]):
+            s, e = int(b_indptr[i]), int(b_indptr[i + 1])
+            parts[t] = [(np.array(b_docs[s:e]), np.array(b_weights[s:e]))]
+        all_ids = list(meta["ids"])
+    offset = len(all_ids)
+    postings = {}
+    for d, weights in enumerate(lexical_weights):
+        for t, w in weights.items():
+            if w > 0:
+                postings.setdefault(str(t), []).append((offset + d, w))
+    for t, plist in postings.items():
+        parts.setdefault(t, []).append((
+            np.fromiter((p[0] for p in plist), dtype=np.int32, count=len(plist)),
+            np.fromiter((p[1] for p in plist), dtype=np.float16, count=len(plist)),
+        ))
+    all_ids.extend(ids)
+    terms = sorted(parts)
+    indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+    docs_parts, weight_parts = [], []
+    for i, t in enumerate(terms):
+        for dd, ww in parts[t]:
+            docs_parts.append(dd)
+            weight_parts.append(ww)
+        indptr[i + 1] = indptr[i] + sum(len(dd) for dd, _ in parts[t])
+    _write_postings(out_dir, terms, indptr, docs_parts, weight_parts, all_ids, np.float16)
+
+
+def _write_postings(out_dir: Path, terms, indptr, docs_parts, weight_parts, ids, weight_dtype):
+    arrays = {
+        "indptr": indptr,
+        "docs": np.concatenate(docs_parts).astype(np.int32) if docs_parts else np.zeros(0, dtype=np.int32),
+        "weights": np.concatenate(weight_parts).astype(weight_dtype) if weight_parts else np.zeros(0, dtype=weight_dtype),
+    }
+    for name, arr in arrays.items():
+        tmp = out_dir / f"{name}.tmp.npy"
+        np.save(tmp, arr)
+        os.replace(tmp, out_dir / f"{name}.npy")
+    # written last: its mtime marks the postings as complete
+    tmp = out_dir / "terms.json.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"terms": terms, "ids": list(ids)}, f)
+    os.replace(tmp, out_dir / "terms.json")
+
+
+def ingest_rows(rows, book_id: str, dense_cb=None, bm25_cb=None):
+    """Build a new index generation with `rows` added and publish it atomically."""
+    with snapshots.writer():
+        base = snapshots.current()
+        gen = snapshots.begin(base)
+        try:
+            build_dense_index([dict(r) for r in rows], progress_cb=dense_cb, gen=gen, base=base)
+            if SPARSE_MODE == "lexical" and not LEXICAL_KEEP_BM25:
+                # the lexical postings were built in the dense pass; BM25 would be a second sparse index
+                df = write_chunk_catalog(progress_cb=bm25_cb, gen=gen)
+            else:
+                df = build_bm25([dict(r) for r in rows], progress_cb=bm25_cb, gen=gen)
+        except Exception:
+            snapshots.discard(gen)
+            raise
+        catalog = {
+            "books": sorted(set(df["book_id"].tolist())),
+            "chunks": int(len(df)),
+            "parent": base.name,
+            "added_book": book_id,
+        }
+        return snapshots.publish(gen, catalog)
 
 
 def main():
@@ -120,17 +286,10 @@ def main():
     pages = list(extract_pages(pdf_path))
     rows = list(chunk_pages(pages, args.book_id))
 
-    # For reuse across dense & bm25
-    rows_for_dense = [dict(r) for r in rows]
-    rows_for_bm25 = [dict(r) for r in rows]
-
-    # 2) dense index
-    build_dense_index(rows_for_dense)
-
-    # 3) bm25
-    build_bm25(rows_for_bm25)
+    # 2) dense index + 3) bm25, into a new generation published on success
+    gen = ingest_rows(rows, args.book_id)
 
-    print(f"Ingested {len(rows)} chunks from {pdf_path}")
+    print(f"Ingested {len(rows)} chunks from {pdf_path} (generation {gen.name})")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,196 @@
+"""Routing of generation requests across several Ollama hosts.
+
+OLLAMA_BASE_URLS (comma-separated; falls back to OLLAMA_BASE_URL) lists the backends.
+Each request goes to the healthy backend with the fewest in-flight requests, ties broken
+by recent time-to-first-token. A connection failure marks the backend unhealthy for
+OLLAMA_HEALTH_COOLDOWN_S and the request is retried on the next backend; HTTP errors
+from a reachable backend are not retried. Counters are per process.
+"""
+import os, threading, time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Set
+
+import requests
+
+from config import OLLAMA_HEALTH_COOLDOWN_S, OLLAMA_TTFT_ALPHA
+
+DEFAULT_BASE = "http://localhost:11434"
+
+
+def _ewma(prev: Optional[float], sample: float) -> float:
+    return sample if prev is None else OLLAMA_TTFT_ALPHA * sample + (1.0 - OLLAMA_TTFT_ALPHA) * prev
+
+
+class Backend:
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.inflight = 0
+        self.total = 0
+        self.failures = 0
+        self.healthy = True
+        self.unhealthy_until = 0.0
+        self.ttft_ms: Optional[float] = None       # streamed requests only
+        self.latency_ms: Optional[float] = None    # full latency of non-streamed requests
+        self.last_error: Optional[str] = None
+        self.version: Optional[str] = None
+
+    def status(self) -> Dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "inflight": self.inflight,
+            "total": self.total,
+            "failures": self.failures,
+            "ttft_ms": round(self.ttft_ms, 1) if self.ttft_ms is not None else None,
+            "latency_ms": round(self.latency_ms, 1) if self.latency_ms is not None else None,
+            "version": self.version,
+            "last_error": self.last_error,
+        }
+
+
+class OllamaPool:
+    def __init__(self, urls: List[str]):
+        if not urls:
+            raise ValueError("OllamaPool needs at least one backend URL")
+        self.backends = [Backend(u) for u in urls]
+        self._lock = threading.Lock()
+
+    def _eligible(self, b: Backend, now: float) -> bool:
+        # an unhealthy backend gets another chance once its cooldown has passed
+        return b.healthy or now >= b.unhealthy_until
+
+    def acquire(self, exclude: Optional[Set[str]] = None) -> Optional[Backend]:
+        """Reserve the least-loaded eligible backend (None when all are excluded)."""
+        exclude = exclude or set()
+        now = time.time()
+        with self._lock:
+            cands = [b for b in self.backends if b.url not in exclude]
+            if not cands:
+                return None
+            live = [b for b in cands if self._eligible(b, now)] or cands
+            best = min(live, key=lambda b: (b.inflight, b.ttft_ms if b.ttft_ms is not None else 0.0))
+            best.inflight += 1
+            best.total += 1
+            return best
+
+    def release(
+        self,
+        b: Backend,
+        ttft_ms: Optional[float] = None,
+        error: Optional[Exception] = None,
+        latency_ms: Optional[float] = None,
+    ):
+        with self._lock:
+            b.inflight = max(0, b.inflight - 1)
+            if error is not None:
+                self._mark_down(b, error)
+            else:
+                b.healthy = True
+                b.last_error = None
+                if ttft_ms is not None:
+                    b.ttft_ms = _ewma(b.ttft_ms, ttft_ms)
+                if latency_ms is not None:
+                    b.latency_ms = _ewma(b.latency_ms, latency_ms)
+
+    def _mark_down(self, b: Backend, error: Exception):
+        b.healthy = False
+        b.failures += 1
+        b.last_error = str(error)
+        b.unhealthy_until = time.time() + OLLAMA_HEALTH_COOLDOWN_S
+
+    @contextmanager
+    def post(self, path: str, **kwargs) -> Iterator[tuple]:
+        """POST to the least-loaded backend, failing over on connection errors (not read timeouts).
+
+        Yields (backend, response, mark_first_token); streamed callers call mark_first_token()
+        when the first output arrives, which feeds the backend's TTFT. A request that never
+        marks one (non-streamed) feeds `latency_ms` instead, so whole generations do not pass
+        for slow first tokens. The backend's in-flight slot is held until the block exits.
+        """
+        tried: Set[str] = set()
+        last_exc: Optional[Exception] = None
+        while True:
+            b = self.acquire(exclude=tried)
+            if b is None:
+                raise last_exc or RuntimeError("No Ollama backend available")
+            t0 = time.perf_counter()
+            try:
+                r = requests.post(f"{b.url}{path}", **kwargs)
+            except requests.ConnectionError as e:
+                # includes ConnectTimeout; a ReadTimeout means the host is alive but slow,
+                # and re-sending the generation elsewhere would only double the work
+                self.release(b, error=e)
+                tried.add(b.url)
+                last_exc = e
+                continue
+            except BaseException:
+                # any other failure still frees the slot, or least-loaded routing drifts
+                self.release(b)
+                raise
+            first: Dict[str, float] = {}
+
+            def mark_first_token():
+                first.setdefault("ms", (time.perf_counter() - t0) * 1000.0)
+
+            try:
+                with r:
+                    yield b, r, mark_first_token
+            except requests.ConnectionError as e:
+                # dropped mid-response: too late to retry, but the backend is suspect
+                self.release(b, error=e)
+                raise
+            except BaseException:
+                self.release(b)
+                raise
+            if "ms" in first:
+                self.release(b, ttft_ms=first["ms"])
+            else:
+                self.release(b, latency_ms=(time.perf_counter() - t0) * 1000.0)
+            return
+
+    def any_url(self) -> str:
+        """A backend URL for one-off calls (model listing): least-loaded eligible one.
+
+        Read-only: nothing is reserved, so no health state is touched for a host not contacted.
+        """
+        now = time.time()
+        with self._lock:
+            live = [b for b in self.backends if self._eligible(b, now)] or self.backends
+            return min(live, key=lambda b: (b.inflight, b.ttft_ms if b.ttft_ms is not None else 0.0)).url
+
+    def check_health(self, timeout: float = 5.0) -> List[Dict]:
+        """Probe every backend's /api/version and update its health."""
+        for b in self.backends:
+            try:
+                r = requests.get(f"{b.url}/api/version", timeout=timeout)
+                r.raise_for_status()
+                ver = r.json()
+                with self._lock:
+                    b.version = ver.get("version") if isinstance(ver, dict) else str(ver)
+                    b.healthy = True
+                    b.last_error = None
+            except Exception as e:
+                with self._lock:
+                    self._mark_down(b, e)
+        return self.status()
+
+    def status(self) -> List[Dict]:
+        with self._lock:
+            return [b.status() for b in self.backends]
+
+
+_POOL: Optional[OllamaPool] = None
+_POOL_LOCK = threading.Lock()
+
+
+def backend_urls() -> List[str]:
+    raw = os.getenv("OLLAMA_BASE_URLS") or os.getenv("OLLAMA_BASE_URL", DEFAULT_BASE)
+    return [u.strip() for u in raw.split(",") if u.strip()]
+
+
+def get_pool() -> OllamaPool:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = OllamaPool(backend_urls())
+        return _POOL
@@ -1,18 +1,25 @@
-import argparse, json, pickle, math, os
+import argparse, json, pickle, math, os, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from typing import List, Dict, Optional, Iterable
-import requests
 
 import lancedb
-from sentence_transformers import SentenceTransformer
-from FlagEmbedding import FlagReranker
 import numpy as np
 import yaml
 
 from config import (
-    LANCE_DIR, BM25_PATH, EMBED_MODEL_NAME, RERANK_MODEL_NAME,
-    DENSE_TOPK, BM25_TOPK, FUSION_TOPK, RERANK_TOPK, OLLAMA_MODEL, MAX_TOKENS, RRF_K,
+    RERANK_MAX_LENGTH, RERANK_BATCH_SIZE, RERANK_BUCKETED, RERANK_WINDOW_WORDS,
+    DENSE_TOPK, BM25_TOPK, FUSION_TOPK, RERANK_TOPK, MAX_TOKENS, RRF_K,
     MMR_LAMBDA, ENABLE_TERM_EXPANSION, TERMS_MAP_PATH,
+    BATCH_CONCURRENCY, BATCH_RETRIEVAL_CHUNK, NOTE_SUB_QUERIES, NOTE_QUERY_FACETS, DENSE_QUANT,
+    SPARSE_MODE, RETRIEVAL_BUDGET_MS, DEGRADE_QUEUE_DEPTH, DEGRADED_FUSION_TOPK, DEGRADE_MIN_RERANK, STAGE_COST_ALPHA,
+    STAGE_SKIP_DECAY,
 )
+import dense_quant
+import runtime
+from ollama_pool import get_pool as get_ollama_pool
+import snapshots
+from inference import load_embedder, load_reranker
+from term_matcher import TermMatcher
 from templates import (
     SYSTEM_BASE,
     QA_TEMPLATE,
@@ -22,49 +29,156 @@ from templates import (
     PROCEDURE,
 )
 
-# Lazy global caches for models and term map
-_EMBED_MODEL: Optional[SentenceTransformer] = None
-_RERANKER: Optional[FlagReranker] = None
-_TERMS_MAP: Optional[Dict[str, List[str]]] = None
+# Lazy global caches for models and term map (backend chosen by INFERENCE_BACKEND)
+_EMBED_MODEL = None
+_RERANKER = None
+_TERMS: Optional[tuple] = None   # (terms.yaml mtime, normalized map, compiled TermMatcher)
+_BM25: Dict[str, tuple] = {}   # bm25.pkl path -> (mtime, unpickled index)
+_POSTINGS: Dict[str, tuple] = {}   # BM25 / lexical postings dir -> (mtime, memory-mapped arrays)
 
+# Chunk columns returned by searches; `embedding` is fetched separately when needed
+CHUNK_COLUMNS = ["id", "text", "book_id", "page_start", "page_end"]
 
-def get_embed_model() -> SentenceTransformer:
+# Counters copied from Ollama's final `done` message into streaming stats
+OLLAMA_STAT_KEYS = (
+    "total_duration", "load_duration", "prompt_eval_count", "prompt_eval_duration",
+    "eval_count", "eval_duration",
+)
+
+# Retrievals in flight in this process and EWMA stage costs, for deadline-aware degradation
+_INFLIGHT = 0
+_INFLIGHT_LOCK = threading.Lock()
+_STAGE_MS: Dict[str, float] = {}   # "candidates:qa" / "candidates:note" -> ms per hybrid pass, "rerank_pair" -> ms per pair
+
+
+def get_embed_model():
     global _EMBED_MODEL
     if _EMBED_MODEL is None:
-        _EMBED_MODEL = SentenceTransformer(EMBED_MODEL_NAME)
+        _EMBED_MODEL = load_embedder()
     return _EMBED_MODEL
 
 
-def get_reranker() -> FlagReranker:
+def get_reranker():
     global _RERANKER
     if _RERANKER is None:
-        _RERANKER = FlagReranker(RERANK_MODEL_NAME, use_fp16=True)
+        _RERANKER = load_reranker()
     return _RERANKER
 
 
-def load_terms_map() -> Dict[str, List[str]]:
-    global _TERMS_MAP
-    if _TERMS_MAP is None:
-        try:
+def get_bm25() -> Dict:
+    """Unpickled BM25 index of the active index generation."""
+    path = str(snapshots.active().bm25_path)
+    mtime = os.path.getmtime(path)
+    hit = _BM25.get(path)
+    if hit is None or hit[0] != mtime:
+        with open(path, "rb") as f:
+            obj = pickle.load(f)
+        # keep only the newest generation plus whatever in-flight queries are still pinned to
+        for stale in [p for p in _BM25 if p != path and not os.path.exists(p)]:
+            _BM25.pop(stale, None)
+        while len(_BM25) >= 2:
+            _BM25.pop(next(iter(_BM25)))
+        _BM25[path] = hit = (mtime, obj)
+    return hit[1]
+
+
+def _load_postings(pdir) -> Optional[Dict]:
+    """Memory-mapped inverted index written by ingest.py (None when `pdir` has none).
+
+    Pages of the .npy arrays live in the OS page cache, so forked API workers share them.
+    """
+    terms_path = os.path.join(str(pdir), "terms.json")
+    try:
+        mtime = os.path.getmtime(terms_path)
+    except FileNotFoundError:
+        return None
+    key = str(pdir)
+    hit = _POSTINGS.get(key)
+    if hit is None or hit[0] != mtime:
+        with open(terms_path, "r") as f:
+            meta = json.load(f)
+        obj = {
+            "ids": meta["ids"],
+            "terms": {t: i for i, t in enumerate(meta["terms"])},
+            "indptr": np.load(os.path.join(key, "indptr.npy"), mmap_mode="r"),
+            "docs": np.load(os.path.join(key, "docs.npy"), mmap_mode="r"),
+            "weights": np.load(os.path.join(key, "weights.npy"), mmap_mode="r"),
+        }
+        # BM25 + lexical for the current generation and one still-pinned predecessor
+        while len(_POSTINGS) >= 4:
+            _POSTINGS.pop(next(iter(_POSTINGS)))
+        _POSTINGS[key] = hit = (mtime, obj)
+    return hit[1]
+
+
+def get_bm25_postings() -> Optional[Dict]:
+    """BM25 postings of the active generation (None for indexes built before them)."""
+    return _load_postings(snapshots.active().bm25_postings_dir)
+
+
+def get_lexical_postings() -> Optional[Dict]:
+    """bge-m3 lexical-weight postings of the active generation (None unless ingested with SPARSE_MODE="lexical")."""
+    return _load_postings(snapshots.active().lexical_dir)
+
+
+def _lexical_enabled() -> bool:
+    # generations ingested before the switch keep using BM25 until re-ingested
+    return SPARSE_MODE == "lexical" and get_lexical_postings() is not None
+
+
+def _bm25_ids() -> List[str]:
+    postings = get_bm25_postings()
+    return postings["ids"] if postings is not None else get_bm25()["ids"]
+
+
+def warm_up():
+    """Load models and index handles up front (before gunicorn forks its workers)."""
+    get_embed_model()
+    get_reranker()
+    load_terms_map()
+    try:
+        # lexical-mode generations may have no BM25 index at all
+        if not _lexical_enabled() and get_bm25_postings() is None:
+            get_bm25()
+        if DENSE_QUANT in dense_quant.QUANT_MODES:
+            dense_quant.load_index(DENSE_QUANT, in_dir=snapshots.current().dense_quant_dir)
+    except FileNotFoundError:
+        # nothing ingested yet
+        pass
+
+
+def _load_terms() -> tuple:
+    """Normalized terms map and its compiled matcher, reloaded whenever terms.yaml's mtime changes."""
+    global _TERMS
+    try:
+        mtime = os.stat(TERMS_MAP_PATH).st_mtime_ns
+    except OSError:
+        mtime = None
+    if _TERMS is None or _TERMS[0] != mtime:
+        data = {}
+        if mtime is not None:
             with open(TERMS_MAP_PATH, "r") as f:
-                data = yaml.safe_load(f) or {}
-        except FileNotFoundError:
-            data = {}
+                # the C loader parses a large synonym file several times faster
+                data = yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)) or {}
         # normalize keys
-        _TERMS_MAP = {str(k).lower(): [str(v).lower() for v in (vs or [])] for k, vs in data.items()}
-    return _TERMS_MAP
+        mp = {str(k).lower(): [str(v).lower() for v in (vs or [])] for k, vs in data.items()}
+        _TERMS = (mtime, mp, TermMatcher(mp))
+    return _TERMS
+
+
+def load_terms_map() -> Dict[str, List[str]]:
+    return _load_terms()[1]
+
+
+def get_term_matcher() -> TermMatcher:
+    return _load_terms()[2]
 
 
 def expanded_queries_for(q: str) -> List[str]:
     if not ENABLE_TERM_EXPANSION:
         return [q]
-    ql = q.lower()
-    mp = load_terms_map()
-    expansions: List[str] = []
-    for key, syns in mp.items():
-        if key in ql:
-            expansions.extend(syns[:2])
-    expansions = expansions[:6]
+    # whole-word matches of every key in one pass, kept in terms.yaml order
+    expansions = get_term_matcher().expansions(q, per_key=2)[:6]
     if not expansions:
         return [q]
     variants = [q]
@@ -79,73 +193,233 @@ def expanded_queries_for(q: str) -> List[str]:
     return variants
 
 
-def dense_search(query: str, books: Optional[List[str]] = None) -> List[Dict]:
-    db = lancedb.connect(str(LANCE_DIR))
-    tbl = db.open_table("chunks")
-    embed = get_embed_model()
-    qvec = embed.encode(query, normalize_embeddings=True).tolist()
-    # lancedb similarity search
-    rows = tbl.search(qvec).limit(DENSE_TOPK).to_list()
+def _open_chunks():
+    db = lancedb.connect(str(snapshots.active().lance_dir))
+    return db.open_table("chunks")
+
+
+def _sql_quote(v: str) -> str:
+    return "'" + str(v).replace("'", "''") + "'"
+
+
+def fetch_chunks(ids: List[str], columns: List[str]) -> Dict[str, Dict]:
+    """Rows of the chunk table for `ids`, keyed by id."""
+    if not ids:
+        return {}
+    where = f"id IN ({', '.join(_sql_quote(i) for i in ids)})"
+    rows = _open_chunks().search().where(where).select(columns).limit(len(ids)).to_list()
+    return {r["id"]: r for r in rows}
+
+
+def attach_embeddings(rows: List[Dict]) -> List[Dict]:
+    """Fill in `embedding` for rows that were fetched without it (MMR needs them)."""
+    missing = [r["id"] for r in rows if r.get("embedding") is None]
+    if missing:
+        found = fetch_chunks(missing, ["id", "embedding"])
+        for r in rows:
+            if r.get("embedding") is None and r["id"] in found:
+                r["embedding"] = found[r["id"]]["embedding"]
+    return rows
+
+
+def _dense_quant_index() -> Optional[Dict]:
+    """Quantized codes of the active generation, or None if it was built without them."""
+    try:
+        return dense_quant.load_index(DENSE_QUANT, in_dir=snapshots.active().dense_quant_dir)
+    except FileNotFoundError:
+        return None
+
+
+def _dense_search_quant(
+    qvec: List[float], index: Dict, books: Optional[List[str]] = None, k: int = DENSE_TOPK
+) -> List[Dict]:
+    ids = index["ids"]
+    mask = None
+    if books:
+        bset = set([b.strip() for b in books if b and b.strip()])
+        mask = np.isin(index["book_ids"], list(bset))
+
+    def fetch_vectors(idx: List[int]) -> np.ndarray:
+        found = fetch_chunks([ids[i] for i in idx], ["id", "embedding"])
+        dim = len(qvec)
+        return np.vstack([found[ids[i]]["embedding"] if ids[i] in found else np.zeros(dim) for i in idx])
+
+    hits = dense_quant.two_phase_search(index, np.asarray(qvec, dtype=np.float32), k, fetch_vectors, mask=mask)
+    found = fetch_chunks([ids[i] for i, _ in hits], CHUNK_COLUMNS)
+    rows = []
+    for i, cos in hits:
+        r = found.get(ids[i])
+        if r is None:
+            continue
+        # same scale as LanceDB's default squared-L2 `_distance` on unit vectors
+        r["score_dense"] = 2.0 - 2.0 * cos
+        r["contrib_dense"] = True
+        rows.append(r)
+    return rows
+
+
+def dense_search(query: str, books: Optional[List[str]] = None, qvec: Optional[List[float]] = None) -> List[Dict]:
+    if qvec is None:
+        embed = get_embed_model()
+        qvec = embed.encode(query, normalize_embeddings=True).tolist()
+    if DENSE_QUANT in dense_quant.QUANT_MODES:
+        index = _dense_quant_index()
+        if index is not None:
+            return _dense_search_quant(qvec, index, books=books)
+        # no codes in this generation yet: exact search on the LanceDB table
+    tbl = _open_chunks()
+    # lancedb similarity search; embeddings stay in the table unless MMR asks for them
+    search = tbl.search(qvec).select(CHUNK_COLUMNS)
+    bset = sorted(set([b.strip() for b in books if b and b.strip()])) if books else []
+    if bset:
+        # filter before top-k, like the book mask of the quantized path
+        search = search.where(f"book_id IN ({', '.join(_sql_quote(b) for b in bset)})", prefilter=True)
+    rows = search.limit(DENSE_TOPK).to_list()
     for r in rows:
         r["score_dense"] = r.get("_distance", 0.0)
         r["contrib_dense"] = True
-    if books:
-        bset = set([b.strip() for b in books if b and b.strip()])
-        rows = [r for r in rows if r.get("book_id") in bset]
     return rows
 
 
-def bm25_search(query: str, books: Optional[List[str]] = None) -> List[Dict]:
-    with open(BM25_PATH, "rb") as f:
-        obj = pickle.load(f)
-    bm25, ids = obj["bm25"], obj["ids"]
-    variants = expanded_queries_for(query)
-    db = lancedb.connect(str(LANCE_DIR))
-    tbl = db.open_table("chunks")
-    import pandas as pd  # type: ignore
-    df = tbl.to_pandas()
+def bm25_score_matrix(variants: List[str]) -> np.ndarray:
+    """BM25 scores of every variant against the whole corpus as one (n_variants, n_docs) matmul.
+
+    Equivalent to stacking `bm25.get_scores(v.lower().split())` per variant, but each distinct
+    term's per-document weight vector is computed once and shared across variants.
+    """
+    tokenized = [v.lower().split() for v in variants]
+    vocab = sorted({t for toks in tokenized for t in toks})
+    col = {t: j for j, t in enumerate(vocab)}
+    qmat = np.zeros((len(variants), len(vocab)), dtype=np.float32)
+    for i, toks in enumerate(tokenized):
+        for t in toks:
+            qmat[i, col[t]] += 1.0
+    postings = get_bm25_postings()
+    if postings is not None:
+        return _postings_scores(postings, vocab, qmat)
+    bm25 = get_bm25()["bm25"]
+    n_docs = len(bm25.doc_freqs)
+    doc_len = np.asarray(bm25.doc_len, dtype=np.float32)
+    len_norm = bm25.k1 * (1.0 - bm25.b + bm25.b * doc_len / bm25.avgdl)
+    tmat = np.zeros((len(vocab), n_docs), dtype=np.float32)
+    for j, t in enumerate(vocab):
+        idf = bm25.idf.get(t)
+        if not idf:
+            continue
+        tf = np.fromiter((d.get(t, 0) for d in bm25.doc_freqs), dtype=np.float32, count=n_docs)
+        tmat[j] = idf * tf * (bm25.k1 + 1.0) / (tf + len_norm)
+    return qmat @ tmat
+
+
+def _postings_scores(postings: Dict, vocab: List[str], qmat: np.ndarray) -> np.ndarray:
+    """(n_queries, n_docs) sparse dot products: qmat[:, j] weights term vocab[j]."""
+    out = np.zeros((qmat.shape[0], len(postings["ids"])), dtype=np.float32)
+    # precomputed per-(term, doc) weights: only the docs containing a term are touched
+    for j, t in enumerate(vocab):
+        row = postings["terms"].get(t)
+        if row is None:
+            continue
+        s, e = int(postings["indptr"][row]), int(postings["indptr"][row + 1])
+        out[:, postings["docs"][s:e]] += qmat[:, j:j + 1] * postings["weights"][s:e]
+    return out
+
+
+def lexical_score_matrix(weights: List[Dict[str, float]]) -> np.ndarray:
+    """bge-m3 lexical matching scores (sum of shared-token weight products) of each query vs every chunk."""
+    vocab = sorted({t for w in weights for t in w})
+    col = {t: j for j, t in enumerate(vocab)}
+    qmat = np.zeros((len(weights), len(vocab)), dtype=np.float32)
+    for i, w in enumerate(weights):
+        for t, v in w.items():
+            qmat[i, col[t]] = v
+    return _postings_scores(get_lexical_postings(), vocab, qmat)
+
+
+def _topk_desc(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+
+def bm25_search_variants(variants: List[str], books: Optional[List[str]] = None) -> List[List[Dict]]:
+    """One ranked BM25 hit list (best first) per variant, from a single scoring pass."""
+    return _sparse_hits(bm25_score_matrix(variants), _bm25_ids(), books, "score_bm25")
+
+
+def lexical_search(weights: List[Dict[str, float]], books: Optional[List[str]] = None) -> List[List[Dict]]:
+    """One ranked lexical-weight hit list per query weight dict (from `encode_hybrid`)."""
+    return _sparse_hits(lexical_score_matrix(weights), get_lexical_postings()["ids"], books, "score_lexical")
+
+
+def _sparse_hits(scores: np.ndarray, ids: List[str], books: Optional[List[str]], score_key: str) -> List[List[Dict]]:
+    bset = set([b.strip() for b in books if b and b.strip()]) if books else None
+    tops = [_topk_desc(row_scores, BM25_TOPK) for row_scores in scores]
+    # one lookup for the union of hits instead of loading the whole chunk table
+    found = fetch_chunks(sorted({ids[i] for top in tops for i in top}), CHUNK_COLUMNS)
+    out = []
+    for row_scores, top_idx in zip(scores, tops):
+        rows = []
+        for i in top_idx:
+            rec = found.get(ids[i])
+            if rec is None or (bset is not None and rec.get("book_id") not in bset):
+                continue
+            r = dict(rec)
+            r[score_key] = float(row_scores[i])
+            # fused as the sparse list, whichever index produced it
+            r["contrib_bm25"] = True
+            rows.append(r)
+        out.append(rows)
+    return out
+
+
+def _best_per_chunk(lists: List[List[Dict]], score_key: str) -> List[Dict]:
+    # Best score per chunk across the term-expansion variants, ranked by that score
     out_map: Dict[str, Dict] = {}
-    for vq in variants:
-        scores = bm25.get_scores(vq.lower().split())
-        top_idx = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:BM25_TOPK]
-        id_set = {ids[i] for i in top_idx}
-        sub = df[df["id"].isin(list(id_set))].to_dict(orient="records")
-        bm25_map = {ids[i]: scores[i] for i in top_idx}
-        for r in sub:
-            if books:
-                bset = set([b.strip() for b in books if b and b.strip()])
-                if r.get("book_id") not in bset:
-                    continue
-            rid = r["id"]
-            score = bm25_map.get(rid, 0.0)
-            cur = out_map.get(rid)
-            if cur is None or score > cur.get("score_bm25", 0.0):
-                rr = dict(r)
-                rr["score_bm25"] = score
-                rr["contrib_bm25"] = True
-                out_map[rid] = rr
-    return list(out_map.values())
+    for rows in lists:
+        for r in rows:
+            cur = out_map.get(r["id"])
+            if cur is None or r[score_key] > cur[score_key]:
+                out_map[r["id"]] = r
+    return sorted(out_map.values(), key=lambda r: r[score_key], reverse=True)
+
+
+def bm25_search(query: str, books: Optional[List[str]] = None) -> List[Dict]:
+    return _best_per_chunk(bm25_search_variants(expanded_queries_for(query), books=books), "score_bm25")
 
 
 def rrf_fuse(dense_rows: List[Dict], bm25_rows: List[Dict], k: int = RRF_K, limit: int = FUSION_TOPK) -> List[Dict]:
-    # Compute 1-based ranks within each list
-    r_dense = {r["id"]: i + 1 for i, r in enumerate(dense_rows)}
-    r_bm25 = {r["id"]: i + 1 for i, r in enumerate(bm25_rows)}
+    return rrf_fuse_many([dense_rows], [bm25_rows], k=k, limit=limit)
+
 
+def rrf_fuse_many(
+    dense_lists: List[List[Dict]], bm25_lists: List[List[Dict]], k: int = RRF_K, limit: int = FUSION_TOPK
+) -> List[Dict]:
+    """Reciprocal Rank Fusion over any number of dense and BM25 ranked lists."""
     # Prefer dense row object if present; else bm25 row
-    row_map: Dict[str, Dict] = {r["id"]: r for r in bm25_rows}
-    row_map.update({r["id"]: r for r in dense_rows})
+    row_map: Dict[str, Dict] = {}
+    for rows in bm25_lists:
+        for r in rows:
+            row_map.setdefault(r["id"], r)
+    dense_map: Dict[str, Dict] = {}
+    for rows in dense_lists:
+        for r in rows:
+            dense_map.setdefault(r["id"], r)
+    for rid, r in dense_map.items():
+        for key in ("score_bm25", "score_lexical"):
+            if rid in row_map and key in row_map[rid]:
+                r[key] = row_map[rid][key]
+        row_map[rid] = r
 
     scores: Dict[str, float] = {}
-    for rid in set(list(r_dense.keys()) + list(r_bm25.keys())):
-        s = 0.0
-        if rid in r_dense:
-            s += 1.0 / (k + r_dense[rid])
-            row_map[rid]["contrib_dense"] = True
-        if rid in r_bm25:
-            s += 1.0 / (k + r_bm25[rid])
-            row_map[rid]["contrib_bm25"] = True
-        scores[rid] = s
+    for flag, lists in (("contrib_dense", dense_lists), ("contrib_bm25", bm25_lists)):
+        for rows in lists:
+            # Compute 1-based ranks within each list
+            for i, r in enumerate(rows):
+                rid = r["id"]
+                scores[rid] = scores.get(rid, 0.0) + 1.0 / (k + i + 1)
+                row_map[rid][flag] = True
 
     fused_ids = sorted(scores.keys(), key=lambda rid: scores[rid], reverse=True)[:limit]
     fused = [row_map[rid] for rid in fused_ids]
@@ -154,22 +428,223 @@ def rrf_fuse(dense_rows: List[Dict], bm25_rows: List[Dict], k: int = RRF_K, limi
     return fused
 
 
-def hybrid_candidates(query: str, books: Optional[List[str]] = None) -> List[Dict]:
+def hybrid_candidates(
+    query: str, books: Optional[List[str]] = None, limit: int = FUSION_TOPK, sparse: bool = True
+) -> List[Dict]:
+    if sparse and _lexical_enabled():
+        return _lexical_candidates([query], books=books, limit=limit)[0]
     a = dense_search(query, books=books)
-    b = bm25_search(query, books=books)
-    return rrf_fuse(a, b)
+    b = bm25_search(query, books=books) if sparse else []
+    return rrf_fuse(a, b, limit=limit)
 
 
-def rerank(query: str, cands: List[Dict]) -> List[Dict]:
+def _lexical_candidates(
+    queries: List[str], books: Optional[List[str]] = None, limit: int = FUSION_TOPK
+) -> List[List[Dict]]:
+    """Per query: dense search on the query plus lexical search on its term-expansion variants.
+
+    Every variant of every query goes through a single `encode_hybrid` call, which returns
+    the dense vectors and the bge-m3 lexical weights together.
+    """
+    groups = [expanded_queries_for(q) for q in queries]
+    dense, lexical = get_embed_model().encode_hybrid([v for g in groups for v in g])
+    out, pos = [], 0
+    for q, g in zip(queries, groups):
+        # variant 0 is the query itself
+        a = dense_search(q, books=books, qvec=dense[pos].tolist())
+        b = _best_per_chunk(lexical_search(lexical[pos:pos + len(g)], books=books), "score_lexical")
+        out.append(rrf_fuse(a, b, limit=limit))
+        pos += len(g)
+    return out
+
+
+def hybrid_candidates_many(
+    queries: List[str], books: Optional[List[str]] = None, limit: int = FUSION_TOPK, sparse: bool = True
+) -> List[Dict]:
+    """Candidates for several phrasings of one information need.
+
+    Every query plus its term-expansion variants is encoded in one encoder call and
+    BM25-scored in one matrix pass (or, with lexical sparse mode, gets dense vectors and
+    lexical weights from one `encode_hybrid` call); all ranked lists are then fused in a
+    single RRF. `sparse=False` skips the sparse side (dense-only fallback under deadline pressure).
+    """
+    return hybrid_candidates_groups([queries], books=books, limit=limit, sparse=sparse)[0]
+
+
+def hybrid_candidates_groups(
+    groups: List[List[str]], books: Optional[List[str]] = None, limit: int = FUSION_TOPK, sparse: bool = True
+) -> List[List[Dict]]:
+    """`hybrid_candidates_many` for several information needs at once (one fused list per group).
+
+    The variants of all groups share one encoder call and one sparse scoring pass; a variant
+    that occurs in several groups is encoded and searched once.
+    """
+    variants: List[str] = []
+    pos: Dict[str, int] = {}
+    members: List[List[int]] = []
+    for queries in groups:
+        idx: List[int] = []
+        for q in queries:
+            for v in expanded_queries_for(q):
+                if v not in pos:
+                    pos[v] = len(variants)
+                    variants.append(v)
+                if pos[v] not in idx:
+                    idx.append(pos[v])
+        members.append(idx)
+    if not variants:
+        return [[] for _ in groups]
+    if sparse and _lexical_enabled():
+        qvecs, lexical = get_embed_model().encode_hybrid(variants)
+        sparse_lists = lexical_search(lexical, books=books)
+    else:
+        qvecs = get_embed_model().encode(variants, normalize_embeddings=True)
+        sparse_lists = bm25_search_variants(variants, books=books) if sparse else []
+    dense_lists = [dense_search(v, books=books, qvec=qv.tolist()) for v, qv in zip(variants, qvecs)]
+    if len(groups) == 1:
+        return [rrf_fuse_many(dense_lists, sparse_lists, limit=limit)]
+
+    def own(lists: List[List[Dict]], idx: List[int]) -> List[List[Dict]]:
+        # RRF writes scores into the rows, so every group fuses its own copies
+        return [[dict(r) for r in lists[i]] for i in idx] if lists else []
+
+    return [rrf_fuse_many(own(dense_lists, idx), own(sparse_lists, idx), limit=limit) for idx in members]
+
+
+def hybrid_candidates_batch(queries: List[str], books: Optional[List[str]] = None) -> List[List[Dict]]:
+    """Candidates for many independent queries with one encoder call."""
+    if not queries:
+        return []
+    if _lexical_enabled():
+        return _lexical_candidates(queries, books=books)
+    embed = get_embed_model()
+    qvecs = embed.encode(queries, normalize_embeddings=True)
+    out = []
+    for q, qv in zip(queries, qvecs):
+        a = dense_search(q, books=books, qvec=qv.tolist())
+        b = bm25_search(q, books=books)
+        out.append(rrf_fuse(a, b))
+    return out
+
+
+def _token_lengths(rr, texts: List[str]) -> List[int]:
+    tok = getattr(rr, "tokenizer", None)
+    if tok is not None:
+        try:
+            return [len(ids) for ids in tok(texts, add_special_tokens=False)["input_ids"]]
+        except Exception:
+            pass
+    # rough fallback: ~4 characters per token
+    return [len(t) // 4 + 1 for t in texts]
+
+
+def query_window(query: str, text: str, words: int = RERANK_WINDOW_WORDS) -> str:
+    """The `words`-word span of `text` with the most query-term hits (whole text if short or disabled)."""
+    toks = text.split()
+    if words <= 0 or len(toks) <= words:
+        return text
+    qterms = {w.strip(".,;:()[]").lower() for w in query.split()}
+    qterms = {w for w in qterms if len(w) > 2}
+    hits = np.array([1 if t.strip(".,;:()[]").lower() in qterms else 0 for t in toks], dtype=np.int32)
+    csum = np.concatenate([[0], np.cumsum(hits)])
+    stride = max(1, words // 4)
+    starts = list(range(0, len(toks) - words + 1, stride))
+    if starts[-1] != len(toks) - words:
+        starts.append(len(toks) - words)
+    best = max(starts, key=lambda i: csum[i + words] - csum[i])
+    return " ".join(toks[best:best + words])
+
+
+def rerank_scores(pairs: List[List[str]], bucketed: bool = RERANK_BUCKETED) -> List[float]:
+    """Cross-encoder scores for (query, passage) pairs, returned in input order.
+
+    Bucketed mode sorts pairs by token length so each batch pads to its own longest
+    pair, and passes a per-batch `max_length` (rounded up to 32, capped at
+    RERANK_MAX_LENGTH) instead of padding every batch against the global cap.
+    """
+    if not pairs:
+        return []
     rr = get_reranker()
+    if RERANK_WINDOW_WORDS > 0:
+        pairs = [[q, query_window(q, t)] for q, t in pairs]
+    if not bucketed:
+        scores = rr.compute_score(pairs, batch_size=RERANK_BATCH_SIZE)
+        return [float(x) for x in (scores if isinstance(scores, list) else [scores])]
+    lens = _token_lengths(rr, [q + " " + t for q, t in pairs])
+    order = sorted(range(len(pairs)), key=lambda i: lens[i])
+    out = [0.0] * len(pairs)
+    for s in range(0, len(order), RERANK_BATCH_SIZE):
+        idx = order[s:s + RERANK_BATCH_SIZE]
+        # + special tokens ([CLS] q [SEP][SEP] p [SEP])
+        need = max(lens[i] for i in idx) + 4
+        max_len = min(RERANK_MAX_LENGTH, ((need + 31) // 32) * 32)
+        scores = rr.compute_score([pairs[i] for i in idx], batch_size=len(idx), max_length=max_len)
+        if not isinstance(scores, list):
+            scores = [scores]
+        for i, sc in zip(idx, scores):
+            out[i] = float(sc)
+    return out
+
+
+def rerank(query: str, cands: List[Dict]) -> List[Dict]:
     pairs = [[query, r["text"]] for r in cands]
-    scores = rr.compute_score(pairs, batch_size=16)
+    scores = rerank_scores(pairs)
     for r, s in zip(cands, scores):
         r["score_xenc"] = float(s)
     cands.sort(key=lambda r: r["score_xenc"], reverse=True)
     return cands[:RERANK_TOPK]
 
 
+def rerank_batch(queries: List[str], cand_lists: List[List[Dict]]) -> List[List[Dict]]:
+    """Score every (query, chunk) pair of a batch in a single length-bucketed pass."""
+    pairs = [[q, r["text"]] for q, cands in zip(queries, cand_lists) for r in cands]
+    if not pairs:
+        return [[] for _ in cand_lists]
+    scores = rerank_scores(pairs)
+    out, pos = [], 0
+    for cands in cand_lists:
+        for r in cands:
+            r["score_xenc"] = scores[pos]
+            pos += 1
+        cands.sort(key=lambda r: r["score_xenc"], reverse=True)
+        out.append(cands[:RERANK_TOPK])
+    return out
+
+
+def rerank_compare(queries: List[str], books: Optional[List[str]] = None) -> Dict:
+    """Throughput and score agreement of the configured rerank path vs plain arrival-order batches."""
+    report: Dict = {"queries": len(queries), "pairs": 0, "legacy_s": 0.0, "current_s": 0.0,
+                    "max_abs_diff": 0.0, "topk_overlap": [], "spearman": []}
+    rerank_scores([["warm up", "warm up"]], bucketed=False)
+    for q in queries:
+        pairs = [[q, r["text"]] for r in hybrid_candidates(q, books=books)]
+        if not pairs:
+            continue
+        t0 = time.perf_counter()
+        legacy = get_reranker().compute_score(pairs, batch_size=16)
+        legacy = np.asarray(legacy if isinstance(legacy, list) else [legacy], dtype=np.float32)
+        t1 = time.perf_counter()
+        current = np.asarray(rerank_scores(pairs), dtype=np.float32)
+        t2 = time.perf_counter()
+        report["pairs"] += len(pairs)
+        report["legacy_s"] += t1 - t0
+        report["current_s"] += t2 - t1
+        report["max_abs_diff"] = max(report["max_abs_diff"], float(np.abs(legacy - current).max()))
+        k = min(RERANK_TOPK, len(pairs))
+        top_a, top_b = set(np.argsort(-legacy)[:k]), set(np.argsort(-current)[:k])
+        report["topk_overlap"].append(len(top_a & top_b) / float(k))
+        if len(pairs) > 1:
+            ra, rb = np.argsort(np.argsort(legacy)), np.argsort(np.argsort(current))
+            report["spearman"].append(float(np.corrcoef(ra, rb)[0, 1]))
+    if report["pairs"]:
+        report["legacy_pairs_per_s"] = report["pairs"] / max(report["legacy_s"], 1e-9)
+        report["current_pairs_per_s"] = report["pairs"] / max(report["current_s"], 1e-9)
+        report["speedup"] = report["legacy_s"] / max(report["current_s"], 1e-9)
+    report["topk_overlap"] = float(np.mean(report["topk_overlap"])) if report["topk_overlap"] else None
+    report["spearman"] = float(np.min(report["spearman"])) if report["spearman"] else None
+    return report
+
+
 def mmr_select(cands: List[Dict], k: Optional[int] = None, lam: float = MMR_LAMBDA) -> List[Dict]:
     if k is None:
         k = min(RERANK_TOPK, len(cands))
@@ -186,7 +661,8 @@ def mmr_select(cands: List[Dict], k: Optional[int] = None, lam: float = MMR_LAMB
     norms = np.linalg.norm(embs, axis=1, keepdims=True) + 1e-8
     embs_n = embs / norms
     sim = embs_n @ embs_n.T
-    rel = np.array([r.get("score_xenc", 0.0) for r in cands], dtype=np.float32)
+    # fused rank score stands in for relevance when the cross-encoder was skipped
+    rel = np.array([r.get("score_xenc", r.get("score_rrf", 0.0)) for r in cands], dtype=np.float32)
     if rel.max() > rel.min():
         rel = (rel - rel.min()) / (rel.max() - rel.min())
     selected = []
@@ -217,8 +693,7 @@ def pack_context(rows: List[Dict]) -> str:
 
 
 def call_ollama(system: str, user: str) -> str:
-    base = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
-    model = os.getenv("OLLAMA_MODEL", OLLAMA_MODEL)
+    model = runtime.ollama_model()
     body = {
         "model": model,
         "messages": [
@@ -228,14 +703,13 @@ def call_ollama(system: str, user: str) -> str:
         "options": {"num_predict": MAX_TOKENS},
         "stream": False,
     }
-    r = requests.post(f"{base}/api/chat", json=body, timeout=600)
-    r.raise_for_status()
-    return r.json()["message"]["content"]
+    with get_ollama_pool().post("/api/chat", json=body, timeout=600) as (_, r, _first):
+        r.raise_for_status()
+        return r.json()["message"]["content"]
 
 
-def call_ollama_stream(system: str, user: str) -> Iterable[str]:
-    base = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
-    model = os.getenv("OLLAMA_MODEL", OLLAMA_MODEL)
+def call_ollama_stream(system: str, user: str, stats: Optional[Dict] = None) -> Iterable[str]:
+    model = runtime.ollama_model()
     body = {
         "model": model,
         "messages": [
@@ -245,8 +719,10 @@ def call_ollama_stream(system: str, user: str) -> Iterable[str]:
         "options": {"num_predict": MAX_TOKENS},
         "stream": True,
     }
-    with requests.post(f"{base}/api/chat", json=body, stream=True, timeout=600) as r:
+    with get_ollama_pool().post("/api/chat", json=body, stream=True, timeout=600) as (backend, r, first_token):
         r.raise_for_status()
+        if stats is not None:
+            stats["backend"] = backend.url
         for line in r.iter_lines(decode_unicode=True):
             if not line:
                 continue
@@ -255,82 +731,397 @@ def call_ollama_stream(system: str, user: str) -> Iterable[str]:
             except Exception:
                 continue
             if obj.get("done"):
+                # final message carries Ollama's eval counters (durations in ns)
+                if stats is not None:
+                    stats["model"] = obj.get("model", model)
+                    for key in OLLAMA_STAT_KEYS:
+                        if key in obj:
+                            stats[key] = obj[key]
                 break
             msg = obj.get("message", {})
             chunk = msg.get("content", "")
             if chunk:
+                first_token()
                 yield chunk
 
 
-def answer_qa(q: str, books: Optional[List[str]] = None, return_rows: bool = False):
-    cands = hybrid_candidates(q, books=books)
-    topk = rerank(q, cands)
-    topk = mmr_select(topk)
-    context = pack_context(topk)
-    prompt = QA_TEMPLATE.format(question=q, context=context)
-    ans = call_ollama(SYSTEM_BASE, prompt)
-    return (ans, topk) if return_rows else ans
+def _elapsed_ms(t0: float) -> float:
+    return round((time.perf_counter() - t0) * 1000.0, 1)
 
 
-def answer_qa_stream(q: str, books: Optional[List[str]] = None) -> Iterable[str]:
-    cands = hybrid_candidates(q, books=books)
-    topk = rerank(q, cands)
-    topk = mmr_select(topk)
-    context = pack_context(topk)
-    prompt = QA_TEMPLATE.format(question=q, context=context)
-    return call_ollama_stream(SYSTEM_BASE, prompt)
+class Deadline:
+    """Latency budget of one request, counted from construction.
+
+    `retrieve` checks it before each stage and records every shortcut it takes in
+    `degraded` (e.g. "fusion_topk=50", "skip_rerank", "dense_only").
+    """
+
+    def __init__(self, budget_ms: Optional[float] = RETRIEVAL_BUDGET_MS):
+        self.budget_ms = float(budget_ms) if budget_ms else None
+        self.t0 = time.perf_counter()
+        self.degraded: List[str] = []
+
+    def remaining_ms(self) -> float:
+        if self.budget_ms is None:
+            return math.inf
+        return self.budget_ms - (time.perf_counter() - self.t0) * 1000.0
+
+    def degrade(self, what: str):
+        """Record a shortcut; "name=value" replaces an earlier entry of the same name."""
+        if "=" in what:
+            name = what.split("=", 1)[0] + "="
+            self.degraded = [d for d in self.degraded if not d.startswith(name)]
+        if what not in self.degraded:
+            self.degraded.append(what)
+
+
+def _observe_stage(stage: str, ms: float):
+    prev = _STAGE_MS.get(stage)
+    _STAGE_MS[stage] = ms if prev is None else STAGE_COST_ALPHA * ms + (1.0 - STAGE_COST_ALPHA) * prev
+
+
+def _skip_stage(stage: str):
+    # a stage skipped on its estimate is never re-measured, so shrink the estimate instead;
+    # after a few skips it fits the budget again and the next real run re-samples it
+    if stage in _STAGE_MS:
+        _STAGE_MS[stage] *= STAGE_SKIP_DECAY
+
+
+def _load_for_timing():
+    """Trigger lazy model and index loads outside the timed stages, so a cold load never
+    becomes a stage-cost sample."""
+    get_embed_model()
+    get_reranker()
+    get_term_matcher()
+    try:
+        if not _lexical_enabled() and get_bm25_postings() is None:
+            get_bm25()
+        if DENSE_QUANT in dense_quant.QUANT_MODES:
+            _dense_quant_index()
+    except FileNotFoundError:
+        pass
+
+
+def _enter_retrieval() -> int:
+    global _INFLIGHT
+    with _INFLIGHT_LOCK:
+        _INFLIGHT += 1
+        return _INFLIGHT
+
+
+def _exit_retrieval():
+    global _INFLIGHT
+    with _INFLIGHT_LOCK:
+        _INFLIGHT -= 1
+
+
+def _plan_retrieval(deadline: Optional[Deadline], depth: int, stage: str):
+    """(fusion limit, use BM25, use cross-encoder) for the queue depth and time left.
+
+    `stage` names the candidate-stage estimate: qa and note (sub-query) passes differ in cost.
+    """
+    limit, sparse, xenc = FUSION_TOPK, True, True
+    if deadline is None or deadline.budget_ms is None:
+        # no budget (budget_ms 0): always the full pipeline, whatever the queue depth
+        return limit, sparse, xenc
+    if DEGRADE_QUEUE_DEPTH and depth >= DEGRADE_QUEUE_DEPTH:
+        limit = min(limit, DEGRADED_FUSION_TOPK)
+        deadline.degrade(f"fusion_topk={limit}")
+        if depth >= 2 * DEGRADE_QUEUE_DEPTH:
+            xenc = False
+            deadline.degrade("skip_rerank")
+        if depth >= 3 * DEGRADE_QUEUE_DEPTH:
+            sparse = False
+            deadline.degrade("dense_only")
+    if depth <= 1:
+        # alone on this worker: the budget never cuts stages, whatever the estimates say
+        return limit, sparse, xenc
+    est = _STAGE_MS.get(stage)
+    if sparse and est is not None and deadline.remaining_ms() < est:
+        sparse = False
+        deadline.degrade("dense_only")
+        _skip_stage(stage)
+    return limit, sparse, xenc
+
+
+def _fit_rerank(cands: List[Dict], deadline: Deadline):
+    """Trim candidates to what the cross-encoder can score in the time left; (cands, rerank?)."""
+    per_pair = _STAGE_MS.get("rerank_pair")
+    if per_pair is None or not cands:
+        return cands, True
+    affordable = int(max(0.0, deadline.remaining_ms()) / max(per_pair, 1e-3))
+    if affordable >= len(cands):
+        return cands, True
+    if affordable < DEGRADE_MIN_RERANK:
+        deadline.degrade("skip_rerank")
+        _skip_stage("rerank_pair")
+        return cands, False
+    deadline.degrade(f"fusion_topk={affordable}")
+    return cands[:affordable], True
+
+
+def retrieve(
+    query: str,
+    books: Optional[List[str]] = None,
+    timings: Optional[Dict[str, float]] = None,
+    sub_queries: Optional[List[str]] = None,
+    deadline: Optional[Deadline] = None,
+) -> List[Dict]:
+    """Hybrid retrieve -> rerank -> MMR. Stage timings (ms) are written into `timings` if given.
+
+    With `sub_queries`, candidates come from all of them in one `hybrid_candidates_many`
+    pass; reranking still scores against `query`.
+
+    With a `deadline`, stages are cut back when this worker's queue is deep or the budget
+    would not cover them (smaller fusion set, RRF order instead of the cross-encoder,
+    dense-only candidates); the list lands in `deadline.degraded` and `timings["degraded"]`.
+    """
+    timings = timings if timings is not None else {}
+    depth = _enter_retrieval()
+    try:
+        # every index read below sees the same generation, even if an ingest publishes mid-request
+        with snapshots.pinned() as gen:
+            timings["generation"] = gen.name
+            _load_for_timing()
+            stage = "candidates:note" if sub_queries else "candidates:qa"
+            limit, sparse, xenc = _plan_retrieval(deadline, depth, stage)
+            t0 = time.perf_counter()
+            if sub_queries:
+                cands = hybrid_candidates_many(sub_queries, books=books, limit=limit, sparse=sparse)
+            else:
+                cands = hybrid_candidates(query, books=books, limit=limit, sparse=sparse)
+            timings["retrieve_ms"] = _elapsed_ms(t0)
+            if sparse:
+                _observe_stage(stage, timings["retrieve_ms"])
+            t1 = time.perf_counter()
+            if xenc and deadline is not None and deadline.budget_ms is not None and depth > 1:
+                cands, xenc = _fit_rerank(cands, deadline)
+            if xenc:
+                topk = rerank(query, cands)
+                timings["rerank_ms"] = _elapsed_ms(t1)
+                if cands:
+                    _observe_stage("rerank_pair", timings["rerank_ms"] / len(cands))
+            else:
+                topk = cands[:RERANK_TOPK]
+                timings["rerank_ms"] = 0.0
+            t2 = time.perf_counter()
+            topk = mmr_select(attach_embeddings(topk))
+            timings["mmr_ms"] = _elapsed_ms(t2)
+    finally:
+        _exit_retrieval()
+    if deadline is not None:
+        timings["budget_ms"] = deadline.budget_ms
+        timings["degraded"] = list(deadline.degraded)
+    return topk
+
+
+def retrieve_batch(
+    queries: List[str],
+    books: Optional[List[str]] = None,
+    sub_queries: Optional[List[Optional[List[str]]]] = None,
+) -> List[List[Dict]]:
+    """`retrieve` for a list of queries with batched encoding and reranking.
+
+    `sub_queries[i]`, when given, replaces query i's candidate search the way it does in
+    `retrieve`; the sub-queries of all items are encoded and sparse-scored together
+    (`hybrid_candidates_groups`), and reranking is batched as well.
+    """
+    sub_queries = sub_queries or [None] * len(queries)
+    with snapshots.pinned():
+        grouped = [i for i, sub in enumerate(sub_queries) if sub]
+        plain = [i for i, sub in enumerate(sub_queries) if not sub]
+        cand_lists: List[List[Dict]] = [[] for _ in queries]
+        if grouped:
+            for i, cands in zip(grouped, hybrid_candidates_groups([sub_queries[i] for i in grouped], books=books)):
+                cand_lists[i] = cands
+        if plain:
+            for i, cands in zip(plain, hybrid_candidates_batch([queries[i] for i in plain], books=books)):
+                cand_lists[i] = cands
+        return [mmr_select(attach_embeddings(topk)) for topk in rerank_batch(queries, cand_lists)]
 
 
-def answer_note(topic: str, template: str = "general", books: Optional[List[str]] = None, return_rows: bool = False):
+def note_seed_query(topic: str) -> str:
     # retrieve a bit broader for notes (add key terms expansion)
-    seed_q = (
+    return (
         f"{topic} definition overview key concepts mechanism pathophysiology clinical features diagnostics criteria "
         f"staging severity management treatment dosing contraindications complications monitoring guidelines differentials red flags scoring"
     )
-    cands = hybrid_candidates(seed_q, books=books)
-    topk = rerank(seed_q, cands)
-    topk = mmr_select(topk)
-    context = pack_context(topk)
 
+
+def note_sub_queries(topic: str) -> Optional[List[str]]:
+    """Focused retrieval queries for a note card (None when NOTE_SUB_QUERIES is off)."""
+    if not NOTE_SUB_QUERIES:
+        return None
+    return [f"{topic} {facet}" for facet in NOTE_QUERY_FACETS]
+
+
+def note_template(template: str) -> str:
     t = (template or "general").lower()
     if t == "disease":
-        tmpl = DISEASE
-    elif t == "drug":
-        tmpl = DRUG
-    elif t in ("procedure"):
-        tmpl = PROCEDURE
-    else:
-        tmpl = GENERAL
+        return DISEASE_1PAGER
+    if t == "drug":
+        return DRUG_CARD
+    if t in ("procedure", "algorithm", "algo"):
+        return PROCEDURE
+    return NOTE_CARD
+
 
-    prompt = tmpl.format(topic=topic, context=context)
+def _generation_events(prompt: str, timings: Dict[str, float], t_start: float) -> Iterable[Dict]:
+    stats: Dict = {}
+    t0 = time.perf_counter()
+    first = True
+    for chunk in call_ollama_stream(SYSTEM_BASE, prompt, stats=stats):
+        if first:
+            timings["ttft_ms"] = _elapsed_ms(t0)
+            first = False
+        yield {"event": "token", "text": chunk}
+    timings["generate_ms"] = _elapsed_ms(t0)
+    timings["total_ms"] = _elapsed_ms(t_start)
+    yield {"event": "stats", "timings": timings, "ollama": stats}
+
+
+def answer_qa(
+    q: str, books: Optional[List[str]] = None, return_rows: bool = False, deadline: Optional[Deadline] = None
+):
+    topk = retrieve(q, books=books, deadline=deadline or Deadline())
+    context = pack_context(topk)
+    prompt = QA_TEMPLATE.format(question=q, context=context)
     ans = call_ollama(SYSTEM_BASE, prompt)
     return (ans, topk) if return_rows else ans
 
 
-def answer_note_stream(topic: str, template: str = "general", books: Optional[List[str]] = None) -> Iterable[str]:
-    seed_q = (
-        f"{topic} definition overview key concepts mechanism pathophysiology clinical features diagnostics criteria "
-        f"staging severity management treatment dosing contraindications complications monitoring guidelines differentials red flags scoring"
-    )
-    cands = hybrid_candidates(seed_q, books=books)
-    topk = rerank(seed_q, cands)
-    topk = mmr_select(topk)
+def answer_qa_stream(
+    q: str, books: Optional[List[str]] = None, deadline: Optional[Deadline] = None
+) -> Iterable[str]:
+    topk = retrieve(q, books=books, deadline=deadline or Deadline())
     context = pack_context(topk)
+    prompt = QA_TEMPLATE.format(question=q, context=context)
+    return call_ollama_stream(SYSTEM_BASE, prompt)
 
-    t = (template or "general").lower()
-    if t == "disease":
-        tmpl = DISEASE_1PAGER
-    elif t == "drug":
-        tmpl = DRUG_CARD
-    elif t in ("procedure", "algorithm", "algo"):
-        tmpl = PROCEDURE
-    else:
-        tmpl = NOTE_CARD
 
-    prompt = tmpl.format(topic=topic, context=context)
+def answer_qa_events(
+    q: str, books: Optional[List[str]] = None, deadline: Optional[Deadline] = None
+) -> Iterable[Dict]:
+    """Structured stream: one `sources` event, then `token` events, then a final `stats` event."""
+    t_start = time.perf_counter()
+    timings: Dict[str, float] = {}
+    topk = retrieve(q, books=books, timings=timings, deadline=deadline or Deadline())
+    yield {"event": "sources", "rows": topk}
+    prompt = QA_TEMPLATE.format(question=q, context=pack_context(topk))
+    yield from _generation_events(prompt, timings, t_start)
+
+
+def answer_note(
+    topic: str,
+    template: str = "general",
+    books: Optional[List[str]] = None,
+    return_rows: bool = False,
+    deadline: Optional[Deadline] = None,
+):
+    seed_q = note_seed_query(topic)
+    topk = retrieve(seed_q, books=books, sub_queries=note_sub_queries(topic), deadline=deadline or Deadline())
+    context = pack_context(topk)
+
+    prompt = note_template(template).format(topic=topic, context=context)
+    ans = call_ollama(SYSTEM_BASE, prompt)
+    return (ans, topk) if return_rows else ans
+
+
+def answer_note_stream(
+    topic: str, template: str = "general", books: Optional[List[str]] = None, deadline: Optional[Deadline] = None
+) -> Iterable[str]:
+    seed_q = note_seed_query(topic)
+    topk = retrieve(seed_q, books=books, sub_queries=note_sub_queries(topic), deadline=deadline or Deadline())
+    context = pack_context(topk)
+    prompt = note_template(template).format(topic=topic, context=context)
     return call_ollama_stream(SYSTEM_BASE, prompt)
 
 
+def answer_note_events(
+    topic: str, template: str = "general", books: Optional[List[str]] = None, deadline: Optional[Deadline] = None
+) -> Iterable[Dict]:
+    """Structured stream for note cards; same event sequence as `answer_qa_events`."""
+    t_start = time.perf_counter()
+    timings: Dict[str, float] = {}
+    topk = retrieve(
+        note_seed_query(topic), books=books, timings=timings,
+        sub_queries=note_sub_queries(topic), deadline=deadline or Deadline(),
+    )
+    yield {"event": "sources", "rows": topk}
+    prompt = note_template(template).format(topic=topic, context=pack_context(topk))
+    yield from _generation_events(prompt, timings, t_start)
+
+
+def _batch_generate(index: int, item: str, mode: str, template: str, rows: List[Dict]) -> Dict:
+    t0 = time.perf_counter()
+    out: Dict = {"index": index, "input": item, "rows": rows}
+    try:
+        if mode == "qa":
+            prompt = QA_TEMPLATE.format(question=item, context=pack_context(rows))
+        else:
+            prompt = note_template(template).format(topic=item, context=pack_context(rows))
+        out["output"] = call_ollama(SYSTEM_BASE, prompt)
+    except Exception as e:
+        out["error"] = str(e)
+    out["generate_ms"] = _elapsed_ms(t0)
+    return out
+
+
+def answer_batch(
+    items: List[str],
+    mode: str = "qa",
+    template: str = "general",
+    books: Optional[List[str]] = None,
+    concurrency: int = BATCH_CONCURRENCY,
+) -> Iterable[Dict]:
+    """Answer many questions/topics; yields one result dict per item as it completes (any order).
+
+    Retrieval runs in chunks of BATCH_RETRIEVAL_CHUNK with batched encoding and reranking,
+    while generation for earlier chunks is already in flight on at most `concurrency` Ollama calls.
+    """
+    concurrency = max(1, int(concurrency))
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        pending = set()
+        for start in range(0, len(items), BATCH_RETRIEVAL_CHUNK):
+            chunk = items[start:start + BATCH_RETRIEVAL_CHUNK]
+            if mode == "qa":
+                queries, subs = chunk, None
+            else:
+                # same retrieval as a single /api/note card
+                queries, subs = [note_seed_query(t) for t in chunk], [note_sub_queries(t) for t in chunk]
+            try:
+                rows_list = retrieve_batch(queries, books=books, sub_queries=subs)
+            except Exception as e:
+                for i, item in enumerate(chunk):
+                    yield {"index": start + i, "input": item, "rows": [], "error": str(e)}
+                continue
+            for i, (item, rows) in enumerate(zip(chunk, rows_list)):
+                pending.add(pool.submit(_batch_generate, start + i, item, mode, template, rows))
+            # hand back whatever finished while this chunk was retrieving
+            done = {f for f in pending if f.done()}
+            pending -= done
+            for f in done:
+                yield f.result()
+            # keep retrieval from running far ahead of generation
+            while len(pending) > concurrency * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    yield f.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                yield f.result()
+
+
+def _read_batch_items(path: str) -> List[str]:
+    f = sys.stdin if path == "-" else open(path, "r")
+    try:
+        return [line.strip() for line in f if line.strip()]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
 def main():
     # Compatibility layer: support top-level --mode, --q, --topic
     pre = argparse.ArgumentParser(add_help=False)
@@ -363,12 +1154,33 @@ def main():
     note.add_argument("--topic", required=True)
     note.add_argument("--template", choices=["general", "disease", "drug", "procedure"], default="general")
 
+    batch = sub.add_parser("batch", help="answer one question/topic per line; prints JSON lines as they complete")
+    batch.add_argument("--file", required=True, help="input file with one item per line ('-' for stdin)")
+    batch.add_argument("--kind", choices=["qa", "note"], default="note")
+    batch.add_argument("--template", choices=["general", "disease", "drug", "procedure"], default="general")
+    batch.add_argument("--books", help="comma-separated book ids")
+    batch.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+
+    rb = sub.add_parser("rerank-bench", help="compare bucketed/windowed reranking against plain batches")
+    rb.add_argument("--q", action="append", required=True, help="query (repeatable)")
+    rb.add_argument("--books", help="comma-separated book ids")
+
     args = ap.parse_args(remaining)
 
     if args.mode == "qa":
         print(answer_qa(args.q))
-    else:
+    elif args.mode == "note":
         print(answer_note(args.topic, template=args.template))
+    elif args.mode == "rerank-bench":
+        books = [b.strip() for b in args.books.split(",") if b.strip()] if args.books else None
+        print(json.dumps(rerank_compare(args.q, books=books), indent=2))
+    else:
+        items = _read_batch_items(args.file)
+        books = [b.strip() for b in args.books.split(",") if b.strip()] if args.books else None
+        for res in answer_batch(items, mode=args.kind, template=args.template, books=books, concurrency=args.concurrency):
+            rows = res.pop("rows", [])
+            res["sources"] = [f"{r.get('book_id')}:{r.get('page_start')}-{r.get('page_end')}" for r in rows]
+            print(json.dumps(res), flush=True)
 
 
 if __name__ == "__main__":
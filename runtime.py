@@ -0,0 +1,194 @@
+"""State shared by all API worker processes, kept in small JSON files under RUNTIME_DIR.
+
+Forked workers share no Python memory, so anything one worker changes at runtime
+(the admin-selected Ollama model, ingest and batch job progress) is written here with
+an atomic replace. Readers re-parse a file only when its mtime changes, so a
+change made through one worker is picked up by every other worker on its next read.
+Per-item job results go to an append-only NDJSON file next to the job's status file.
+
+Job files outlive the process that runs the job, so each unfinished job records its owner
+`pid` and a heartbeat (`updated_at`); readers turn one whose owner is gone or whose heartbeat
+is older than JOB_STALE_S into an "error" job instead of reporting it as running forever.
+"""
+import fcntl, json, os, re, threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from config import RUNTIME_DIR, OLLAMA_MODEL, JOB_HEARTBEAT_S, JOB_STALE_S
+
+SETTINGS_FILE = "settings.json"
+JOB_ACTIVE = ("queued", "ingesting", "running")
+
+_CACHE: "OrderedDict[str, tuple]" = OrderedDict()   # path -> (mtime_ns, parsed json), LRU
+CACHE_MAX = 256
+
+
+def _write_json(path: Path, obj: Any):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+
+def _read_json(path: Path, default: Any = None) -> Any:
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return default
+    hit = _CACHE.get(str(path))
+    if hit is None or hit[0] != mtime:
+        try:
+            with open(path, "r") as f:
+                obj = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return default
+        _CACHE[str(path)] = hit = (mtime, obj)
+        while len(_CACHE) > CACHE_MAX:
+            _CACHE.popitem(last=False)
+    _CACHE.move_to_end(str(path))
+    return hit[1]
+
+
+@contextmanager
+def _locked(name: str) -> Iterator[None]:
+    RUNTIME_DIR.mkdir(parents=True, exist_ok=True)
+    with open(RUNTIME_DIR / f".{name}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def get_setting(key: str, default: Any = None) -> Any:
+    return (_read_json(RUNTIME_DIR / SETTINGS_FILE, {}) or {}).get(key, default)
+
+
+def set_setting(key: str, value: Any):
+    with _locked("settings"):
+        path = RUNTIME_DIR / SETTINGS_FILE
+        data = dict(_read_json(path, {}) or {})
+        data[key] = value
+        _write_json(path, data)
+
+
+def ollama_model() -> str:
+    """Model chosen via /api/ollama/set_model, else OLLAMA_MODEL env, else config default."""
+    return get_setting("ollama_model") or os.getenv("OLLAMA_MODEL", OLLAMA_MODEL)
+
+
+def _job_path(kind: str, job_id: str) -> Path:
+    safe = re.sub(r"[^A-Za-z0-9_.-]", "_", job_id)
+    return RUNTIME_DIR / "jobs" / kind / f"{safe}.json"
+
+
+def save_job(kind: str, job_id: str, job: Dict[str, Any]):
+    _write_json(_job_path(kind, job_id), job)
+
+
+def update_job(kind: str, job_id: str, **fields) -> Dict[str, Any]:
+    """Merge `fields` into a job owned by this process and refresh its heartbeat."""
+    with _locked(f"jobs.{kind}"):
+        job = dict(_read_json(_job_path(kind, job_id)) or {})
+        job.update(fields)
+        job["pid"] = os.getpid()
+        job["updated_at"] = datetime.utcnow().isoformat()
+        save_job(kind, job_id, job)
+    return job
+
+
+@contextmanager
+def job_heartbeat(kind: str, job_id: str) -> Iterator[None]:
+    """Keep refreshing the job's heartbeat while the block runs (long steps report no progress)."""
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(JOB_HEARTBEAT_S):
+            update_job(kind, job_id)
+
+    t = threading.Thread(target=beat, daemon=True)
+    t.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        t.join()
+
+
+def _pid_alive(pid: Any) -> bool:
+    try:
+        os.kill(int(pid), 0)
+    except (TypeError, ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _job_stale(job: Dict[str, Any]) -> bool:
+    if job.get("status") not in JOB_ACTIVE:
+        return False
+    try:
+        age = (datetime.utcnow() - datetime.fromisoformat(job.get("updated_at") or "")).total_seconds()
+    except ValueError:
+        return True
+    # the pid check only catches a dead owner on this host; a reused pid still stops beating
+    return age > JOB_STALE_S or not _pid_alive(job.get("pid"))
+
+
+def _expire_if_stale(kind: str, job_id: str, job: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if job is None or not _job_stale(job):
+        return job
+    with _locked(f"jobs.{kind}"):
+        job = _read_json(_job_path(kind, job_id))
+        if job is None or not _job_stale(job):
+            return job
+        job = dict(job)
+        job.update(status="error", error="interrupted: the worker running this job exited")
+        save_job(kind, job_id, job)
+    return job
+
+
+def append_job_result(kind: str, job_id: str, result: Dict[str, Any]):
+    """Append one result line; a job's results have a single writer (its worker thread)."""
+    path = _job_path(kind, job_id).with_suffix(".results.ndjson")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+
+def load_job_results(kind: str, job_id: str, since: int = 0) -> List[Dict[str, Any]]:
+    """Results after the first `since`; a line still being written is left for the next poll."""
+    path = _job_path(kind, job_id).with_suffix(".results.ndjson")
+    out: List[Dict[str, Any]] = []
+    try:
+        with open(path, "r") as f:
+            for i, line in enumerate(f):
+                if i < since:
+                    continue
+                if not line.endswith("\n"):
+                    break
+                out.append(json.loads(line))
+    except FileNotFoundError:
+        pass
+    return out
+
+
+def load_job(kind: str, job_id: str) -> Optional[Dict[str, Any]]:
+    return _expire_if_stale(kind, job_id, _read_json(_job_path(kind, job_id)))
+
+
+def list_jobs(kind: str) -> List[Dict[str, Any]]:
+    d = RUNTIME_DIR / "jobs" / kind
+    if not d.exists():
+        return []
+    jobs = []
+    for p in d.glob("*.json"):
+        job = _expire_if_stale(kind, p.stem, _read_json(p))
+        if job is not None:
+            jobs.append(job)
+    return jobs
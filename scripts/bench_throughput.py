@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""Load-test /api/retrieve and report throughput, latency and per-worker memory.
+
+Compare single- vs multi-worker serving:
+  WEB_CONCURRENCY=1 gunicorn -c gunicorn.conf.py server:app &   # or plain uvicorn
+  python scripts/bench_throughput.py --concurrency 8 --requests 200 --master-pid <gunicorn pid>
+  WEB_CONCURRENCY=4 gunicorn -c gunicorn.conf.py server:app &
+  python scripts/bench_throughput.py --concurrency 8 --requests 200 --master-pid <gunicorn pid>
+
+Requests are sent with budget_ms=0 so every worker count runs the full pipeline
+(no deadline or queue-depth degradation); any shortcut a server still took is
+counted under "degraded".
+
+Memory is reported as PSS (proportional set size), which splits shared pages between
+the processes that map them, so shared model weights are not counted once per worker.
+"""
+import argparse, json, statistics, time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+DEFAULT_QUERIES = [
+    "What determines mean arterial pressure?",
+    "metformin contraindications",
+    "diabetic ketoacidosis management",
+    "renal autoregulation mechanism",
+    "causes of microcytic anemia",
+    "heart failure with reduced ejection fraction treatment",
+]
+
+
+def _pss_kb(pid: int) -> int:
+    try:
+        for line in Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines():
+            if line.startswith("Pss:"):
+                return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _children(pid: int):
+    try:
+        return [int(c) for c in Path(f"/proc/{pid}/task/{pid}/children").read_text().split()]
+    except OSError:
+        return []
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", default="http://localhost:8000")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--requests", type=int, default=200)
+    ap.add_argument("--q", action="append", help="query (repeatable); defaults to a built-in set")
+    ap.add_argument("--master-pid", type=int, help="gunicorn master (or uvicorn) pid for memory stats")
+    args = ap.parse_args()
+    queries = args.q or DEFAULT_QUERIES
+
+    def one(i: int):
+        t0 = time.perf_counter()
+        body = {"q": queries[i % len(queries)], "budget_ms": 0}
+        r = requests.post(f"{args.url}/api/retrieve", json=body, timeout=300)
+        r.raise_for_status()
+        data = r.json()
+        return time.perf_counter() - t0, data.get("pid"), (data.get("timings") or {}).get("degraded") or []
+
+    one(0)  # warm-up
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(one, range(args.requests)))
+    wall = time.perf_counter() - t0
+    lat = sorted(r[0] for r in results)
+    report = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "rps": args.requests / wall,
+        "p50_ms": statistics.median(lat) * 1000.0,
+        "p95_ms": lat[int(0.95 * (len(lat) - 1))] * 1000.0,
+        "workers_hit": len({r[1] for r in results}),
+        "degraded_requests": sum(1 for r in results if r[2]),
+        "degraded": dict(Counter(d for r in results for d in r[2])),
+    }
+    if args.master_pid:
+        workers = _children(args.master_pid)
+        report["master_pss_mb"] = _pss_kb(args.master_pid) / 1024.0
+        report["worker_pss_mb"] = [round(_pss_kb(p) / 1024.0, 1) for p in workers]
+        report["total_pss_mb"] = report["master_pss_mb"] + sum(report["worker_pss_mb"])
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
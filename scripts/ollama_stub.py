@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Minimal stand-in for an Ollama server, for exercising the backend pool locally.
+
+  python scripts/ollama_stub.py --port 11501 --ttft 0.5 --tokens 20 &
+  python scripts/ollama_stub.py --port 11502 --ttft 2.0 &
+  OLLAMA_BASE_URLS=http://localhost:11501,http://localhost:11502,http://localhost:11599 uvicorn server:app
+
+Serves /api/version, /api/tags and /api/chat (streaming NDJSON or a single JSON reply).
+"""
+import argparse, json, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_handler(args):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _json(self, obj, status=200):
+            body = json.dumps(obj).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/api/version":
+                self._json({"version": f"stub-{args.port}"})
+            elif self.path == "/api/tags":
+                self._json({"models": [{"name": args.model}]})
+            else:
+                self._json({"error": "not found"}, 404)
+
+        def do_POST(self):
+            if self.path != "/api/chat":
+                return self._json({"error": "not found"}, 404)
+            req = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            model = req.get("model", args.model)
+            done = {"model": model, "done": True, "eval_count": args.tokens, "prompt_eval_count": 1}
+            time.sleep(args.ttft)
+            words = [f"tok{i} " for i in range(args.tokens)]
+            if not req.get("stream"):
+                time.sleep(args.token_delay * args.tokens)
+                return self._json({**done, "message": {"role": "assistant", "content": "".join(words)}})
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            def chunk(obj):
+                data = (json.dumps(obj) + "\n").encode()
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            for w in words:
+                chunk({"model": model, "done": False, "message": {"role": "assistant", "content": w}})
+                time.sleep(args.token_delay)
+            chunk(done)
+            self.wfile.write(b"0\r\n\r\n")
+
+        def log_message(self, *a):
+            pass
+
+    return Handler
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=11501)
+    ap.add_argument("--model", default="stub:latest")
+    ap.add_argument("--ttft", type=float, default=0.5, help="seconds before the first token")
+    ap.add_argument("--token-delay", type=float, default=0.02)
+    ap.add_argument("--tokens", type=int, default=20)
+    args = ap.parse_args()
+    ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(args)).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,10 @@
 from pathlib import Path
+import json
 import os
 import subprocess
 import threading
 import time
+import uuid
 import requests
 from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
@@ -10,9 +12,16 @@ from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 
 import lancedb
-from query import answer_qa, answer_note, answer_qa_stream, answer_note_stream
-from config import LANCE_DIR, OLLAMA_MODEL, DATA_DIR
-from typing import Dict, Any
+from query import (
+    answer_qa, answer_note, answer_qa_stream, answer_note_stream,
+    answer_qa_events, answer_note_events, answer_batch, retrieve, warm_up, Deadline,
+)
+import runtime
+import snapshots
+from ollama_pool import get_pool as get_ollama_pool
+from singleflight import SingleFlight
+from config import DATA_DIR, BATCH_CONCURRENCY, BATCH_MAX_ITEMS, RETRIEVAL_BUDGET_MS, COALESCE_REQUESTS
+from typing import Dict, Any, Iterable, List, Optional
 from datetime import datetime
 
 app = FastAPI(title="MedNotes RAG API", version="0.1.0")
@@ -34,8 +43,11 @@ _dist = Path("web/dist")
 WEB_DIR = _dist if _dist.exists() else Path("web")
 WEB_DIR.mkdir(exist_ok=True)
 
-# In-memory ingest jobs registry
-INGEST_JOBS: Dict[str, Dict[str, Any]] = {}
+# Ingest and batch job registries live in runtime.py job files so every worker sees them
+
+# gunicorn.conf.py sets PRELOAD_MODELS=1: load models/indexes once in the master before fork
+if os.getenv("PRELOAD_MODELS") == "1":
+    warm_up()
 
 
 @app.get("/api/health")
@@ -43,6 +55,16 @@ def health():
     return {"status": "ok"}
 
 
+@app.get("/api/index")
+def index_info():
+    gen = snapshots.current()
+    return {
+        "generation": gen.name,
+        "catalog": gen.catalog(),
+        "generations": [g.name for g in snapshots.list_generations()],
+    }
+
+
 @app.get("/api/books")
 def list_books():
     # List books solely from data/books/*.pdf
@@ -59,7 +81,7 @@ def list_books():
 
 def _book_exists(book_id: str) -> bool:
     try:
-        db = lancedb.connect(str(LANCE_DIR))
+        db = lancedb.connect(str(snapshots.current().lance_dir))
         tbl = db.open_table("chunks")
         import pandas as pd  # type: ignore
         df = tbl.to_pandas(columns=["book_id"])  # reduce payload
@@ -69,33 +91,28 @@ def _book_exists(book_id: str) -> bool:
 
 
 def _update_job(book_id: str, **fields):
-    job = INGEST_JOBS.get(book_id) or {"book_id": book_id}
-    job.update(fields)
-    job["updated_at"] = datetime.utcnow().isoformat()
-    INGEST_JOBS[book_id] = job
+    runtime.update_job("ingest", book_id, book_id=book_id, **fields)
 
 
 def _run_ingest_job(book_id: str, pdf_path: Path):
-    from ingest import extract_pages, chunk_pages, build_dense_index, build_bm25
+    from ingest import extract_pages, chunk_pages, ingest_rows
     try:
-        _update_job(book_id, status="ingesting", percent=10, message="saved_pdf", started_at=datetime.utcnow().isoformat())
-        pages = list(extract_pages(pdf_path))
-        _update_job(book_id, status="ingesting", percent=25, message="extracted_pages", pages=len(pages))
-        rows = list(chunk_pages(pages, book_id))
-        _update_job(book_id, status="ingesting", percent=45, message="chunked", chunks=len(rows))
-
-        rows_for_dense = [dict(r) for r in rows]
-        rows_for_bm25 = [dict(r) for r in rows]
-        def cb_dense(frac: float):
-            pct = 45 + int(30 * max(0.0, min(1.0, frac)))
-            _update_job(book_id, status="ingesting", percent=pct, message="embedding")
-        build_dense_index(rows_for_dense, progress_cb=cb_dense)
-        _update_job(book_id, status="ingesting", percent=75, message="dense_index_built")
-        def cb_bm25(frac: float):
-            pct = 75 + int(20 * max(0.0, min(1.0, frac)))
-            _update_job(book_id, status="ingesting", percent=pct, message="bm25")
-        build_bm25(rows_for_bm25, progress_cb=cb_bm25)
-        _update_job(book_id, status="complete", percent=100, message="done")
+        with runtime.job_heartbeat("ingest", book_id):
+            _update_job(book_id, status="ingesting", percent=10, message="saved_pdf", started_at=datetime.utcnow().isoformat())
+            pages = list(extract_pages(pdf_path))
+            _update_job(book_id, status="ingesting", percent=25, message="extracted_pages", pages=len(pages))
+            rows = list(chunk_pages(pages, book_id))
+            _update_job(book_id, status="ingesting", percent=45, message="chunked", chunks=len(rows))
+
+            def cb_dense(frac: float):
+                pct = 45 + int(30 * max(0.0, min(1.0, frac)))
+                _update_job(book_id, status="ingesting", percent=pct, message="embedding")
+            def cb_bm25(frac: float):
+                pct = 75 + int(20 * max(0.0, min(1.0, frac)))
+                _update_job(book_id, status="ingesting", percent=pct, message="bm25")
+            # builds a fresh generation; queries keep using the published one until the swap
+            gen = ingest_rows(rows, book_id, dense_cb=cb_dense, bm25_cb=cb_bm25)
+        _update_job(book_id, status="complete", percent=100, message="done", generation=gen.name)
     except Exception as e:
         _update_job(book_id, status="error", percent=100, error=str(e))
 
@@ -105,7 +122,8 @@ def api_ingest(request: Request, pdf: UploadFile = File(...), book_id: str = For
     require_admin(request)
     if not book_id or not isinstance(book_id, str):
         raise HTTPException(status_code=400, detail="Missing 'book_id'")
-    if _book_exists(book_id) or book_id in INGEST_JOBS:
+    prev = runtime.load_job("ingest", book_id)
+    if _book_exists(book_id) or (prev and prev.get("status") != "error"):
         raise HTTPException(status_code=409, detail="book_id already exists or is being ingested")
     # Save uploaded file
     DATA_DIR.mkdir(parents=True, exist_ok=True)
@@ -126,20 +144,149 @@ def api_ingest(request: Request, pdf: UploadFile = File(...), book_id: str = For
 @app.get("/api/ingest/jobs")
 def api_ingest_jobs():
     # Only show active or failed jobs; hide completed to avoid clutter
-    jobs = [j for j in INGEST_JOBS.values() if j.get("status") != "complete"]
+    jobs = [j for j in runtime.list_jobs("ingest") if j.get("status") != "complete"]
     # most recent first
     jobs.sort(key=lambda j: j.get("updated_at", ""), reverse=True)
     return {"jobs": jobs}
 
 
+# Streaming formats accepted via the `stream` field: true/"text" keeps the raw text stream
+STREAM_MEDIA_TYPES = {
+    "text": "text/plain; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+}
+
+
+def _context_summaries(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [
+        {
+            "id": r.get("id"),
+            "book_id": r.get("book_id"),
+            "page_start": r.get("page_start"),
+            "page_end": r.get("page_end"),
+            "score_dense": r.get("score_dense"),
+            "score_bm25": r.get("score_bm25"),
+            "score_lexical": r.get("score_lexical"),
+            "score_rrf": r.get("score_rrf"),
+            "score_xenc": r.get("score_xenc"),
+            "dense": bool(r.get("contrib_dense")),
+            "bm25": bool(r.get("contrib_bm25")),
+        }
+        for r in rows
+    ]
+
+
+def _stream_format(value: Any) -> Optional[str]:
+    if isinstance(value, str):
+        fmt = value.strip().lower()
+        if fmt not in STREAM_MEDIA_TYPES:
+            raise HTTPException(status_code=400, detail=f"Unknown stream format '{value}'")
+        return fmt
+    return "text" if value else None
+
+
+def _encode_events(events: Iterable[Dict[str, Any]], fmt: str) -> Iterable[str]:
+    try:
+        for ev in events:
+            ev = dict(ev)
+            if ev.get("event") == "sources":
+                ev["contexts"] = _context_summaries(ev.pop("rows", []))
+            if fmt == "sse":
+                name = ev.pop("event")
+                yield f"event: {name}\ndata: {json.dumps(ev)}\n\n"
+            else:
+                yield json.dumps(ev) + "\n"
+    except Exception as e:
+        # headers are already sent; report the failure in-band
+        err = {"detail": str(e)}
+        if fmt == "sse":
+            yield f"event: error\ndata: {json.dumps(err)}\n\n"
+        else:
+            yield json.dumps({"event": "error", **err}) + "\n"
+
+
+def _deadline(payload: Optional[dict]) -> Deadline:
+    """Request deadline from `budget_ms` (0 or null = no budget), default RETRIEVAL_BUDGET_MS."""
+    budget = (payload or {}).get("budget_ms", RETRIEVAL_BUDGET_MS)
+    try:
+        budget = float(budget) if budget is not None else 0.0
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="'budget_ms' must be a number")
+    if budget < 0:
+        raise HTTPException(status_code=400, detail="'budget_ms' must be >= 0")
+    return Deadline(budget)
+
+
+# in-flight /api/qa and /api/note computations of this worker, keyed by _coalesce_key
+_FLIGHTS = SingleFlight()
+
+
+def _coalesce_key(
+    kind: str, text: str, template: Optional[str], books: Optional[List[str]], deadline: Deadline, streamed: bool
+):
+    """Requests with equal keys get the same answer: same input, template, book filter, model
+    and budget (a request without a budget must not receive another request's degraded retrieval)."""
+    return (
+        kind,
+        " ".join(text.split()),
+        (template or "").lower(),
+        tuple(sorted(str(b).strip() for b in books or [])),
+        runtime.ollama_model(),
+        deadline.budget_ms,
+        streamed,
+    )
+
+
+def _single_flight(key, fn):
+    """(fn(), shared): attach to an identical in-flight request instead of recomputing."""
+    if not COALESCE_REQUESTS:
+        return fn(), False
+    return _FLIGHTS.run(key, fn)
+
+
+def _token_text(events: Iterable[Dict[str, Any]]) -> Iterable[str]:
+    """Token texts of an event stream, read up to the first token before returning.
+
+    Retrieval and Ollama errors therefore raise here, while a 500 can still be sent,
+    instead of dropping a plain-text stream that already answered 200.
+    """
+    events = iter(events)
+    head = []
+    for ev in events:
+        if ev.get("event") == "token":
+            head.append(ev["text"])
+            break
+
+    def rest():
+        yield from head
+        for ev in events:
+            if ev.get("event") == "token":
+                yield ev["text"]
+    return rest()
+
+
+def _streaming_response(fmt: str, text_gen, events_fn, key=None) -> StreamingResponse:
+    if key is not None and COALESCE_REQUESTS:
+        # every subscriber of one flight gets the same events; text clients keep only the tokens
+        events, _ = _FLIGHTS.stream(key, events_fn)
+        if fmt == "text":
+            return StreamingResponse(_token_text(events), media_type=STREAM_MEDIA_TYPES["text"])
+        return StreamingResponse(_encode_events(events, fmt), media_type=STREAM_MEDIA_TYPES[fmt])
+    if fmt == "text":
+        return StreamingResponse(text_gen(), media_type=STREAM_MEDIA_TYPES["text"])
+    return StreamingResponse(_encode_events(events_fn(), fmt), media_type=STREAM_MEDIA_TYPES[fmt])
+
+
 @app.post("/api/qa")
 def api_qa(payload: dict):
     q = (payload or {}).get("q")
-    stream = bool((payload or {}).get("stream", False))
+    stream = _stream_format((payload or {}).get("stream", False))
     books = (payload or {}).get("books")
     debug = bool((payload or {}).get("debug", False))
     if not q or not isinstance(q, str):
         raise HTTPException(status_code=400, detail="Missing 'q' string")
+    deadline = _deadline(payload)
     # normalize books: allow comma-separated string or list
     if isinstance(books, str):
         books = [b.strip() for b in books.split(",") if b.strip()]
@@ -147,28 +294,20 @@ def api_qa(payload: dict):
         books = None
     try:
         if stream:
-            gen = answer_qa_stream(q, books=books)
-            return StreamingResponse(gen, media_type="text/plain; charset=utf-8")
+            return _streaming_response(
+                stream,
+                lambda: answer_qa_stream(q, books=books, deadline=deadline),
+                lambda: answer_qa_events(q, books=books, deadline=deadline),
+                key=_coalesce_key("qa", q, None, books, deadline, True),
+            )
+        (ans, rows, degraded), shared = _single_flight(
+            _coalesce_key("qa", q, None, books, deadline, False),
+            lambda: (*answer_qa(q, books=books, return_rows=True, deadline=deadline), deadline.degraded),
+        )
+        out = {"answer": ans, "degraded": degraded, "coalesced": shared}
         if debug:
-            ans, rows = answer_qa(q, books=books, return_rows=True)
-            ctx = [
-                {
-                    "id": r.get("id"),
-                    "book_id": r.get("book_id"),
-                    "page_start": r.get("page_start"),
-                    "page_end": r.get("page_end"),
-                    "score_dense": r.get("score_dense"),
-                    "score_bm25": r.get("score_bm25"),
-                    "score_rrf": r.get("score_rrf"),
-                    "score_xenc": r.get("score_xenc"),
-                    "dense": bool(r.get("contrib_dense")),
-                    "bm25": bool(r.get("contrib_bm25")),
-                }
-                for r in rows
-            ]
-            return {"answer": ans, "contexts": ctx}
-        ans = answer_qa(q, books=books)
-        return {"answer": ans}
+            out["contexts"] = _context_summaries(rows)
+        return out
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -177,59 +316,159 @@ def api_qa(payload: dict):
 def api_note(payload: dict):
     topic = (payload or {}).get("topic")
     template = (payload or {}).get("template") or "general"
-    stream = bool((payload or {}).get("stream", False))
+    stream = _stream_format((payload or {}).get("stream", False))
     books = (payload or {}).get("books")
     debug = bool((payload or {}).get("debug", False))
     if not topic or not isinstance(topic, str):
         raise HTTPException(status_code=400, detail="Missing 'topic' string")
+    deadline = _deadline(payload)
     if isinstance(books, str):
         books = [b.strip() for b in books.split(",") if b.strip()]
     if books and not isinstance(books, list):
         books = None
     try:
         if stream:
-            gen = answer_note_stream(topic, template=template, books=books)
-            return StreamingResponse(gen, media_type="text/plain; charset=utf-8")
+            return _streaming_response(
+                stream,
+                lambda: answer_note_stream(topic, template=template, books=books, deadline=deadline),
+                lambda: answer_note_events(topic, template=template, books=books, deadline=deadline),
+                key=_coalesce_key("note", topic, template, books, deadline, True),
+            )
+        (ans, rows, degraded), shared = _single_flight(
+            _coalesce_key("note", topic, template, books, deadline, False),
+            lambda: (
+                *answer_note(topic, template=template, books=books, return_rows=True, deadline=deadline),
+                deadline.degraded,
+            ),
+        )
+        out = {"card": ans, "degraded": degraded, "coalesced": shared}
         if debug:
-            ans, rows = answer_note(topic, template=template, books=books, return_rows=True)
-            ctx = [
-                {
-                    "id": r.get("id"),
-                    "book_id": r.get("book_id"),
-                    "page_start": r.get("page_start"),
-                    "page_end": r.get("page_end"),
-                    "score_dense": r.get("score_dense"),
-                    "score_bm25": r.get("score_bm25"),
-                    "score_rrf": r.get("score_rrf"),
-                    "score_xenc": r.get("score_xenc"),
-                    "dense": bool(r.get("contrib_dense")),
-                    "bm25": bool(r.get("contrib_bm25")),
-                }
-                for r in rows
-            ]
-            return {"card": ans, "contexts": ctx}
-        ans = answer_note(topic, template=template, books=books)
-        return {"card": ans}
+            out["contexts"] = _context_summaries(rows)
+        return out
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def _parse_books(books: Any) -> Optional[List[str]]:
+    if isinstance(books, str):
+        books = [b.strip() for b in books.split(",") if b.strip()]
+    if books and not isinstance(books, list):
+        books = None
+    return books or None
+
+
+def _batch_result(res: Dict[str, Any]) -> Dict[str, Any]:
+    res = dict(res)
+    res["contexts"] = _context_summaries(res.pop("rows", []))
+    return res
+
+
+def _run_batch_job(job_id: str, items: List[str], mode: str, template: str, books, concurrency: int):
+    completed = 0
+    try:
+        with runtime.job_heartbeat("batch", job_id):
+            for res in answer_batch(items, mode=mode, template=template, books=books, concurrency=concurrency):
+                # results are appended; the status file stays small however long the deck is
+                runtime.append_job_result("batch", job_id, _batch_result(res))
+                completed += 1
+                runtime.update_job("batch", job_id, completed=completed)
+        runtime.update_job("batch", job_id, status="complete")
+    except Exception as e:
+        runtime.update_job("batch", job_id, status="error", error=str(e))
+
+
+@app.post("/api/batch")
+def api_batch(payload: dict):
+    """Answer a list of questions (mode "qa") or note topics (mode "note").
+
+    By default results stream back as NDJSON lines in completion order (each carries its
+    `index`). With `background: true` a job id is returned; poll `/api/batch/{job_id}`.
+    """
+    payload = payload or {}
+    items = payload.get("items")
+    mode = payload.get("mode") or "note"
+    template = payload.get("template") or "general"
+    books = _parse_books(payload.get("books"))
+    concurrency = payload.get("concurrency") or BATCH_CONCURRENCY
+    if not isinstance(items, list) or not items or not all(isinstance(i, str) and i.strip() for i in items):
+        raise HTTPException(status_code=400, detail="'items' must be a non-empty list of strings")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} items per batch")
+    if mode not in ("qa", "note"):
+        raise HTTPException(status_code=400, detail="'mode' must be 'qa' or 'note'")
+    try:
+        concurrency = max(1, min(int(concurrency), BATCH_CONCURRENCY * 4))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="'concurrency' must be an integer")
+    items = [i.strip() for i in items]
+
+    if payload.get("background"):
+        job_id = uuid.uuid4().hex
+        runtime.update_job(
+            "batch", job_id, job_id=job_id, status="running", mode=mode, template=template,
+            total=len(items), completed=0, created_at=datetime.utcnow().isoformat(),
+        )
+        threading.Thread(
+            target=_run_batch_job, args=(job_id, items, mode, template, books, concurrency), daemon=True
+        ).start()
+        return {"status": "running", "job_id": job_id, "total": len(items)}
+
+    def gen():
+        try:
+            for res in answer_batch(items, mode=mode, template=template, books=books, concurrency=concurrency):
+                yield json.dumps(_batch_result(res)) + "\n"
+        except Exception as e:
+            yield json.dumps({"event": "error", "detail": str(e)}) + "\n"
+    return StreamingResponse(gen(), media_type=STREAM_MEDIA_TYPES["ndjson"])
+
+
+@app.get("/api/batch/{job_id}")
+def api_batch_job(job_id: str, since: int = 0):
+    """Job status plus results completed after the first `since` (for incremental polling)."""
+    job = runtime.load_job("batch", job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown batch job")
+    out = dict(job)
+    out["results"] = runtime.load_job_results("batch", job_id, since=max(0, since))
+    return out
+
+
+@app.post("/api/retrieve")
+def api_retrieve(payload: dict):
+    """Retrieval only (no LLM): selected contexts plus stage timings."""
+    q = (payload or {}).get("q")
+    if not q or not isinstance(q, str):
+        raise HTTPException(status_code=400, detail="Missing 'q' string")
+    books = _parse_books((payload or {}).get("books"))
+    deadline = _deadline(payload)
+    timings: Dict[str, Any] = {}
+    try:
+        rows = retrieve(q, books=books, timings=timings, deadline=deadline)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    return {"contexts": _context_summaries(rows), "timings": timings, "pid": os.getpid()}
+
 
 # Ollama utilities and admin endpoints
 @app.get("/api/ollama/health")
 def ollama_health():
-    base = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
-    try:
-        r = requests.get(f"{base}/api/version", timeout=5)
-        r.raise_for_status()
-        ver = r.json()
-    except Exception as e:
-        raise HTTPException(status_code=503, detail=f"Ollama unreachable: {e}")
-    current_model = os.getenv("OLLAMA_MODEL", OLLAMA_MODEL)
-    return {"base": base, "version": ver, "current_model": current_model}
+    pool = get_ollama_pool()
+    backends = pool.check_health()
+    healthy = [b for b in backends if b["healthy"]]
+    if not healthy:
+        errors = "; ".join(f"{b['url']}: {b['last_error']}" for b in backends)
+        raise HTTPException(status_code=503, detail=f"Ollama unreachable: {errors}")
+    current_model = runtime.ollama_model()
+    return {
+        "base": healthy[0]["url"],
+        "version": {"version": healthy[0]["version"]},
+        "current_model": current_model,
+        "backends": backends,
+    }
 
 
 @app.get("/api/ollama/models")
 def ollama_models():
-    base = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+    base = get_ollama_pool().any_url()
     try:
         r = requests.get(f"{base}/api/tags", timeout=10)
         r.raise_for_status()
@@ -246,7 +485,8 @@ def set_ollama_model(request: Request, payload: dict):
     model = (payload or {}).get("model")
     if not model or not isinstance(model, str):
         raise HTTPException(status_code=400, detail="Missing 'model' string")
-    os.environ["OLLAMA_MODEL"] = model
+    # persisted so every worker process switches, not just the one serving this request
+    runtime.set_setting("ollama_model", model)
     return {"status": "ok", "model": model}
 
 
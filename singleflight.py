@@ -0,0 +1,132 @@
+"""Single-flight coalescing of identical concurrent requests (per process).
+
+The first caller for a key runs the computation; callers arriving while it is still in
+flight attach to it instead of starting their own. `run` shares a return value (or
+exception). `stream` shares an iterator of events: a producer thread drains it into a
+buffer and every subscriber replays that buffer from the start, then follows it live,
+so a late joiner still receives the whole token stream. When the last subscriber of a
+stream goes away, the producer stops and closes the event iterator (which ends the
+Ollama request). A key is forgotten as soon as its computation finishes; nothing is cached.
+"""
+import threading
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+
+class _Flight:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.items: List[Any] = []
+        self.done = False
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.subscribers = 1
+        self.cancelled = False
+
+    def push(self, item: Any):
+        with self.cond:
+            self.items.append(item)
+            self.cond.notify_all()
+
+    def finish(self, result: Any = None, error: Optional[BaseException] = None):
+        with self.cond:
+            self.result, self.error, self.done = result, error, True
+            self.cond.notify_all()
+
+    def wait(self) -> Any:
+        with self.cond:
+            while not self.done:
+                self.cond.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def follow(self) -> Iterator[Any]:
+        pos = 0
+        while True:
+            with self.cond:
+                while pos >= len(self.items) and not self.done:
+                    self.cond.wait()
+                batch = self.items[pos:]
+                pos += len(batch)
+                finished = self.done and not batch
+            if finished:
+                if self.error is not None:
+                    raise self.error
+                return
+            # yield outside the lock so a slow client never blocks the producer
+            yield from batch
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _Flight] = {}
+
+    def _join(self, key: Hashable) -> Tuple[_Flight, bool]:
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.subscribers += 1
+                return flight, False
+            flight = self._flights[key] = _Flight()
+            return flight, True
+
+    def _forget(self, key: Hashable, flight: _Flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def run(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """(result of fn, shared); `shared` is True when attached to another caller's run."""
+        flight, leader = self._join(key)
+        if not leader:
+            return flight.wait(), True
+        try:
+            result = fn()
+        except BaseException as e:
+            self._forget(key, flight)
+            flight.finish(error=e)
+            raise
+        self._forget(key, flight)
+        flight.finish(result=result)
+        return result, False
+
+    def stream(self, key: Hashable, events_fn: Callable[[], Iterable[Any]]) -> Tuple[Iterator[Any], bool]:
+        """(event iterator, shared). The first caller's `events_fn` runs on a producer thread
+        so the shared computation does not stop if that caller disconnects."""
+        flight, leader = self._join(key)
+        if leader:
+            threading.Thread(target=self._produce, args=(key, flight, events_fn), daemon=True).start()
+        return self._subscribe(key, flight), not leader
+
+    def _subscribe(self, key: Hashable, flight: _Flight) -> Iterator[Any]:
+        try:
+            yield from flight.follow()
+        finally:
+            # runs when the subscriber finishes or its client disconnects (generator closed)
+            with self._lock:
+                flight.subscribers -= 1
+                abandoned = flight.subscribers == 0 and not flight.done
+                if abandoned and self._flights.get(key) is flight:
+                    # new requests start a fresh flight rather than join a cancelled one
+                    del self._flights[key]
+            if abandoned:
+                flight.cancelled = True
+
+    def _produce(self, key: Hashable, flight: _Flight, events_fn: Callable[[], Iterable[Any]]):
+        events = iter(events_fn())
+        try:
+            for ev in events:
+                if flight.cancelled:
+                    break
+                flight.push(ev)
+        except Exception as e:
+            self._forget(key, flight)
+            flight.finish(error=e)
+            return
+        finally:
+            close = getattr(events, "close", None)
+            if close is not None:
+                close()
+        self._forget(key, flight)
+        flight.finish()
@@ -0,0 +1,202 @@
+"""Immutable, versioned index generations with an atomic CURRENT pointer.
+
+Every ingest builds a complete new generation (LanceDB table, BM25 pickle and
+postings, chunk catalog, quantized codes, lexical postings) under
+storage/generations/<name>.staging, renames it to storage/generations/<name> and then
+swaps storage/CURRENT with os.replace. Readers
+only ever open published, never-modified directories, so they never wait on a writer.
+
+Queries pin a generation for the whole retrieval stage (`pinned()`), so a swap in
+the middle of a request cannot mix old and new indexes. Superseded generations are
+garbage-collected once they are unpinned, older than GENERATIONS_KEEP and past
+GENERATION_GRACE_S (other worker processes may still be reading them).
+
+Before the first snapshot ingest, the legacy flat layout under storage/ is served.
+"""
+import fcntl, json, os, shutil, threading, time, uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from config import (
+    STORAGE_DIR, LANCE_DIR, BM25_PATH, CHUNK_JSONL, DENSE_QUANT_DIR,
+    GENERATIONS_DIR, CURRENT_POINTER, GENERATIONS_KEEP, GENERATION_GRACE_S,
+)
+
+LEGACY = "legacy"
+STAGING_SUFFIX = ".staging"
+CATALOG_FILE = "catalog.json"
+
+# index artifacts besides the LanceDB table, as Generation attributes
+DERIVED_ARTIFACTS = ("bm25_path", "chunk_jsonl", "bm25_postings_dir", "lexical_dir", "dense_quant_dir")
+
+_PINS: Dict[str, int] = {}
+_PINS_LOCK = threading.Lock()
+_ACTIVE = threading.local()
+_WRITER_LOCK = threading.Lock()
+
+
+class Generation:
+    """Paths of one index generation."""
+
+    def __init__(self, name: str, root: Path):
+        self.name = name
+        self.root = Path(root)
+        if name == LEGACY:
+            self.lance_dir, self.bm25_path = LANCE_DIR, BM25_PATH
+            self.chunk_jsonl, self.dense_quant_dir = CHUNK_JSONL, DENSE_QUANT_DIR
+            self.bm25_postings_dir = STORAGE_DIR / "bm25_postings"
+            self.lexical_dir = STORAGE_DIR / "lexical"
+        else:
+            self.lance_dir = self.root / "lancedb"
+            self.bm25_path = self.root / "bm25.pkl"
+            self.chunk_jsonl = self.root / "chunks.jsonl"
+            self.dense_quant_dir = self.root / "dense_quant"
+            self.bm25_postings_dir = self.root / "bm25_postings"
+            self.lexical_dir = self.root / "lexical"
+        self.catalog_path = self.root / CATALOG_FILE
+
+    def catalog(self) -> Dict:
+        try:
+            with open(self.catalog_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def __repr__(self) -> str:
+        return f"Generation({self.name!r})"
+
+
+def current() -> Generation:
+    """The published generation (legacy layout when nothing has been published yet)."""
+    try:
+        name = CURRENT_POINTER.read_text().strip()
+    except FileNotFoundError:
+        name = ""
+    if not name:
+        return Generation(LEGACY, STORAGE_DIR)
+    return Generation(name, GENERATIONS_DIR / name)
+
+
+def active() -> Generation:
+    """Generation pinned by the calling thread, else the current one."""
+    stack = getattr(_ACTIVE, "stack", None)
+    return stack[-1] if stack else current()
+
+
+@contextmanager
+def pinned(gen: Optional[Generation] = None) -> Iterator[Generation]:
+    """Pin a generation for the duration of the block; nested index reads on this thread use it."""
+    gen = gen or active()
+    with _PINS_LOCK:
+        _PINS[gen.name] = _PINS.get(gen.name, 0) + 1
+    stack = getattr(_ACTIVE, "stack", None)
+    if stack is None:
+        stack = _ACTIVE.stack = []
+    stack.append(gen)
+    try:
+        yield gen
+    finally:
+        stack.pop()
+        with _PINS_LOCK:
+            _PINS[gen.name] -= 1
+            if not _PINS[gen.name]:
+                del _PINS[gen.name]
+
+
+@contextmanager
+def writer() -> Iterator[None]:
+    """Serialize ingests within this process and across processes (ingest CLI vs server)."""
+    GENERATIONS_DIR.mkdir(parents=True, exist_ok=True)
+    with _WRITER_LOCK:
+        with open(GENERATIONS_DIR / ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _link_or_copy(src: str, dst: str):
+    # published files are never modified, so a hard link is as good as a copy
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def begin(base: Optional[Generation] = None, carry: bool = False) -> Generation:
+    """Create a staging generation seeded with a copy of `base` (default: current). Call under `writer()`.
+
+    The LanceDB table is copied because ingest appends to it; everything else is rebuilt,
+    unless `carry` is set, in which case the other artifacts are linked over as well (for
+    jobs that rebuild only one of them).
+    """
+    base = base or current()
+    name = datetime.utcnow().strftime("%Y%m%dT%H%M%S%f") + "-" + uuid.uuid4().hex[:6]
+    gen = Generation(name, GENERATIONS_DIR / (name + STAGING_SUFFIX))
+    gen.root.mkdir(parents=True)
+    if Path(base.lance_dir).exists():
+        shutil.copytree(base.lance_dir, gen.lance_dir)
+    if carry:
+        for attr in DERIVED_ARTIFACTS:
+            src, dst = Path(getattr(base, attr)), Path(getattr(gen, attr))
+            if src.is_dir():
+                shutil.copytree(src, dst, copy_function=_link_or_copy)
+            elif src.exists():
+                _link_or_copy(str(src), str(dst))
+    return gen
+
+
+def publish(gen: Generation, catalog: Optional[Dict] = None) -> Generation:
+    """Seal a staging generation, atomically point CURRENT at it, then collect old generations."""
+    cat = dict(catalog or {})
+    cat.update({"generation": gen.name, "published_at": time.time()})
+    with open(gen.catalog_path, "w") as f:
+        json.dump(cat, f)
+    final = Generation(gen.name, GENERATIONS_DIR / gen.name)
+    os.replace(gen.root, final.root)
+    tmp = CURRENT_POINTER.with_name(CURRENT_POINTER.name + ".tmp")
+    tmp.write_text(gen.name + "\n")
+    os.replace(tmp, CURRENT_POINTER)
+    gc()
+    return final
+
+
+def discard(gen: Generation):
+    """Drop a staging generation after a failed ingest."""
+    shutil.rmtree(gen.root, ignore_errors=True)
+
+
+def list_generations() -> List[Generation]:
+    if not GENERATIONS_DIR.exists():
+        return []
+    names = sorted(p.name for p in GENERATIONS_DIR.iterdir() if p.is_dir() and not p.name.endswith(STAGING_SUFFIX))
+    return [Generation(n, GENERATIONS_DIR / n) for n in names]
+
+
+def gc(keep: int = GENERATIONS_KEEP, grace_s: float = GENERATION_GRACE_S) -> List[str]:
+    """Delete superseded generations that are unpinned, beyond the newest `keep`, and past the grace period."""
+    cur = current().name
+    gens = list_generations()
+    now = time.time()
+    removed = []
+    newest = {g.name for g in gens[-keep:]} if keep > 0 else set()
+    # published_at of each generation's successor = when it stopped being current
+    for older, newer in zip(gens[:-1], gens[1:]):
+        if older.name == cur or older.name in newest:
+            continue
+        with _PINS_LOCK:
+            if _PINS.get(older.name):
+                continue
+        superseded_at = newer.catalog().get("published_at", now)
+        if now - superseded_at < grace_s:
+            continue
+        shutil.rmtree(older.root, ignore_errors=True)
+        removed.append(older.name)
+    # staging dirs left behind by crashed ingests
+    for p in GENERATIONS_DIR.glob("*" + STAGING_SUFFIX) if GENERATIONS_DIR.exists() else []:
+        if now - p.stat().st_mtime > max(grace_s, 24 * 3600):
+            shutil.rmtree(p, ignore_errors=True)
+    return removed
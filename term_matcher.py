@@ -0,0 +1,143 @@
+"""Compiled multi-pattern matcher for the terms.yaml synonym map.
+
+Keys are matched on whole words: the key and the query are both split into lowercase
+`\\w+` tokens and an Aho-Corasick automaton over token sequences finds every key in a
+single left-to-right pass over the query, independent of how many keys there are.
+"mi" therefore matches "post mi care" but not "mitral".
+
+CLI:
+  python term_matcher.py bench --terms 50000     # build time + per-query latency vs the substring loop
+"""
+import argparse, json, random, re, time
+from collections import deque
+from typing import Dict, List
+
+_TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text.lower())
+
+
+class TermMatcher:
+    """Aho-Corasick automaton over word tokens; `expansions` keeps the map's key order."""
+
+    def __init__(self, terms: Dict[str, List[str]]):
+        self.keys = list(terms)
+        self.synonyms = [list(terms[k]) for k in self.keys]
+        goto: List[Dict[str, int]] = [{}]
+        out: List[List[int]] = [[]]
+        for idx, key in enumerate(self.keys):
+            node = 0
+            toks = tokenize(key)
+            if not toks:
+                continue
+            for tok in toks:
+                nxt = goto[node].get(tok)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][tok] = nxt
+                    goto.append({})
+                    out.append([])
+                node = nxt
+            out[node].append(idx)
+        fail = [0] * len(goto)
+        # breadth-first: a node's failure link is the longest proper suffix that is also a trie path
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for tok, child in goto[node].items():
+                queue.append(child)
+                f = fail[node]
+                while f and tok not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(tok, 0) if node else 0
+                out[child].extend(out[fail[child]])
+        self._goto, self._fail, self._out = goto, fail, out
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def match(self, text: str) -> List[int]:
+        """Indices (into `keys`) of every key occurring in `text` as whole words, in key order."""
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        hits = set()
+        for tok in tokenize(text):
+            while node and tok not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(tok, 0)
+            if out[node]:
+                hits.update(out[node])
+        return sorted(hits)
+
+    def expansions(self, text: str, per_key: int = 2) -> List[str]:
+        found: List[str] = []
+        for idx in self.match(text):
+            found.extend(self.synonyms[idx][:per_key])
+        return found
+
+
+def _synthetic_terms(n: int, seed: int = 0) -> Dict[str, List[str]]:
+    rng = random.Random(seed)
+    alphabet = "abcdefghijklmnopqrstuvwxyz"
+
+    def word() -> str:
+        return "".join(rng.choice(alphabet) for _ in range(rng.randint(3, 9)))
+
+    terms: Dict[str, List[str]] = {}
+    while len(terms) < n:
+        key = " ".join(word() for _ in range(rng.choice((1, 1, 1, 2, 3))))
+        terms[key] = [word(), word()]
+    return terms
+
+
+def bench(n_terms: int = 50000, n_queries: int = 200, seed: int = 0) -> Dict:
+    """Build time and per-query latency of the compiled matcher vs the old `key in query` loop."""
+    rng = random.Random(seed + 1)
+    terms = _synthetic_terms(n_terms, seed)
+    keys = list(terms)
+    queries = []
+    for _ in range(n_queries):
+        words = [rng.choice(keys) for _ in range(2)] + ["management", "of", "acute", "presentation"]
+        rng.shuffle(words)
+        queries.append(" ".join(words))
+
+    t0 = time.perf_counter()
+    matcher = TermMatcher(terms)
+    build_ms = (time.perf_counter() - t0) * 1000.0
+
+    t0 = time.perf_counter()
+    for q in queries:
+        matcher.expansions(q)
+    compiled_us = (time.perf_counter() - t0) * 1e6 / n_queries
+
+    t0 = time.perf_counter()
+    for q in queries:
+        ql = q.lower()
+        [s for k, syns in terms.items() if k in ql for s in syns[:2]]
+    loop_us = (time.perf_counter() - t0) * 1e6 / n_queries
+
+    return {
+        "terms": n_terms,
+        "trie_nodes": len(matcher._goto),
+        "queries": n_queries,
+        "build_ms": round(build_ms, 1),
+        "compiled_us_per_query": round(compiled_us, 1),
+        "substring_loop_us_per_query": round(loop_us, 1),
+        "speedup": round(loop_us / max(compiled_us, 1e-9), 1),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    be = sub.add_parser("bench")
+    be.add_argument("--terms", type=int, default=50000)
+    be.add_argument("--queries", type=int, default=200)
+    args = ap.parse_args()
+    print(json.dumps(bench(args.terms, args.queries), indent=2))
+
+
+if __name__ == "__main__":
+    main()
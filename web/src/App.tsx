@@ -76,11 +76,11 @@ export default function App() {
     return () => { clearInterval(healthId); clearInterval(booksId); clearInterval(jobsId) }
   }, [])
 
-  async function callStream(endpoint: string, payload: Record<string, unknown>, onChunk: (s: string) => void) {
+  async function callStream(endpoint: string, payload: Record<string, unknown>, onChunk: (s: string) => void, onSources?: (ctx: any[]) => void) {
     const r = await fetch(endpoint, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json', ...NGROK_HEADERS },
-      body: JSON.stringify(payload),
+      body: JSON.stringify({ ...payload, stream: 'ndjson' }),
     })
     if (!r.ok || !r.body) {
       const t = await r.text()
@@ -88,12 +88,26 @@ export default function App() {
     }
     const reader = r.body.getReader()
     const decoder = new TextDecoder()
+    let buf = ''
+    const handle = (line: string) => {
+      if (!line.trim()) return
+      const ev = JSON.parse(line)
+      if (ev.event === 'sources') onSources?.(ev.contexts || [])
+      else if (ev.event === 'token') onChunk(ev.text || '')
+      else if (ev.event === 'error') throw new Error(ev.detail || 'stream error')
+    }
     while (true) {
       const { value, done } = await reader.read()
       if (done) break
-      const chunk = decoder.decode(value, { stream: true })
-      if (chunk) onChunk(chunk)
+      buf += decoder.decode(value, { stream: true })
+      let nl = buf.indexOf('\n')
+      while (nl >= 0) {
+        handle(buf.slice(0, nl))
+        buf = buf.slice(nl + 1)
+        nl = buf.indexOf('\n')
+      }
     }
+    handle(buf)
   }
 
   const run = async () => {
@@ -110,7 +124,7 @@ export default function App() {
         const payload = mode === 'qa'
           ? { q: text.trim(), stream: true, extra: extra || undefined }
           : { topic: text.trim(), template, stream: true, extra: extra || undefined }
-        await callStream(mode === 'qa' ? url('/api/qa') : url('/api/note'), payload, (chunk) => setOut(prev => prev + chunk))
+        await callStream(mode === 'qa' ? url('/api/qa') : url('/api/note'), payload, (chunk) => setOut(prev => prev + chunk), setContexts)
       } else {
         if (mode === 'qa') {
           res = await call(url('/api/qa'), { q: text.trim(), extra: extra || undefined, debug })